@@ -1,7 +1,10 @@
 from fenics import *
+from ufl import replace
 import matplotlib.pyplot as plt 
 import mshr
 import numpy as np
+import hashlib
+import os
 
 class MyGeometry:
     def __init__(self,  min_x = 0, max_x = 2.2, min_y = 0,max_y = 0.41, r = 0.05, center=(0.2, 0.2), params=None):
@@ -16,13 +19,26 @@ class MyGeometry:
         self.center = Point(center[0], center[1])
     
     def generate(self, params=None):
+        # params: mesh_res (resolution of mshr, default 128), cache_dir (mesh cache directory)
+        params = params if params is not None else (self.params or {})
+        res = params.get('mesh_res', 128)
+        cache_dir = params.get('cache_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+        path = self.mesh_cache_path(res, cache_dir)
+        if os.path.exists(path):
+            self.load_mesh(path)
+        else:
+            self.generate_mesh(res)
+            self.save_mesh(path)
+        self.mesh_coor = self.mesh.coordinates()
+        self.num_vertices = self.mesh.num_vertices()
 
+    def generate_mesh(self, res):
         channel = mshr.Rectangle(Point(self.min_x, self.min_y), Point(self.max_x, self.max_y))
         # channel = mshr.Rectangle(Point(0, 0), Point(self.L, self.W))
 
         cylinder = mshr.Circle(self.center, self.r)
         domain = channel  - cylinder
-        self.mesh = mshr.generate_mesh(domain, 128)
+        self.mesh = mshr.generate_mesh(domain, res)
         bndry = MeshFunction("size_t", self.mesh, self.mesh.topology().dim()-1)
         for f in facets(self.mesh):
             mp = f.midpoint()
@@ -35,8 +51,30 @@ class MyGeometry:
             elif mp.distance(self.center) <= self.r:  # cylinder
                 bndry[f] = 5
         self.bndry = bndry
-        self.mesh_coor = self.mesh.coordinates()
-        self.num_vertices = self.mesh.num_vertices()
+
+    def mesh_cache_path(self, res, cache_dir):
+        # keyed by domain bounds, cylinder and resolution
+        key = hashlib.md5(np.array([self.min_x, self.max_x, self.min_y, self.max_y, self.r,
+                                    self.center[0], self.center[1], res], dtype=np.float64).tobytes())
+        return os.path.join(cache_dir, f'mesh_{key.hexdigest()}.h5')
+
+    def load_mesh(self, path):
+        self.mesh = Mesh()
+        f = HDF5File(MPI.comm_world, path, 'r')
+        f.read(self.mesh, '/mesh', False)
+        self.bndry = MeshFunction("size_t", self.mesh, self.mesh.topology().dim()-1)
+        f.read(self.bndry, '/bndry')
+        f.close()
+
+    def save_mesh(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so concurrent workers never read a partial file
+        tmp = f'{path}.{os.getpid()}.tmp.h5'
+        f = HDF5File(MPI.comm_world, tmp, 'w')
+        f.write(self.mesh, '/mesh')
+        f.write(self.bndry, '/bndry')
+        f.close()
+        os.replace(tmp, path)
 
 
 class MyFunctionSpace:
@@ -62,6 +100,23 @@ class MySolver:
         # self.u_in = Expression(('0.001', '0.0'), degree=2)
         self.center = np.array([0.2,0.2])
         self.r = 0.05
+        # ang_vel is a runtime parameter, so a new control only updates a value (no JIT recompile)
+        self.u_c = Expression(("ang_vel * (x[1] - cy)", "-1 * ang_vel * (x[0] - cx)"),
+                      degree=2, ang_vel=0.0, cx=self.geometry.center[0], cy=self.geometry.center[1])
+        self.bc_cylinder = None
+        # persistent mode: build the NonlinearVariationalSolver once and reuse it every step
+        self.persistent = self.params.get('persistent_solver', True)
+        self.solver_ready = False
+        # adaptive mode: steps are chosen from the CFL number. While a control is held for several output steps
+        # of params['dt'] one solver step may span many of them (observations are interpolated), so quiet flows
+        # take fewer solves; a step never crosses a change of control. dt_max: None only bounds by the hold
+        self.adaptive = self.params.get('adaptive_dt', False)
+        self.cfl = self.params.get('cfl', 0.8)
+        self.dt_min = self.params.get('dt_min', self.params['dt'] / 20)
+        self.dt_max = self.params.get('dt_max', None)
+        # linear mode: F is linear in sol (convection extrapolated from u_n / u_1), so each step is one linear
+        # solve instead of Newton; 'lu' (mumps), None keeps Newton
+        self.linear = self.params.get('linear_solve', None)
     
     def fixed_boundary_conditions(self):
         self.bc_walls = DirichletBC(self.function_space.V.sub(0), (0, 0), self.geometry.bndry, 3)
@@ -70,8 +125,16 @@ class MySolver:
 
     def changeable_boundary_conditions(self, ang_vel):
         # print('ang velocity :{}'.format(ang_vel))
-        u_c = Expression((f" {ang_vel} * {self.geometry.r} * ( x[1] - {self.geometry.center[1]} )/ {self.geometry.r}  ", f" -1* {ang_vel} * {self.geometry.r} * ( x[0] - {self.geometry.center[0]} )/ {self.geometry.r}  "), degree=2)
-        self.bc_cylinder = DirichletBC(self.function_space.V.sub(0), u_c, self.geometry.bndry, 5)
+        self.u_c.ang_vel = float(ang_vel)
+        if self.bc_cylinder is None:
+            self.bc_cylinder = DirichletBC(self.function_space.V.sub(0), self.u_c, self.geometry.bndry, 5)
+
+    def update_solver(self, ang_vel):
+        # set the cylinder velocity, (re)building bcs & solver only when needed
+        self.changeable_boundary_conditions(ang_vel)
+        if not (self.persistent and self.solver_ready):
+            self.generate_bc()
+            self.generate_solver()
 
     def generate_bc(self):
         self.bcs = [self.bc_walls, self.bc_in, self.bc_cylinder]
@@ -89,10 +152,13 @@ class MySolver:
         u_t,   p_t = TestFunctions(V)
         theta = 0.5
         
-        F = (Constant(3.0/dt/2.0)*inner(u,u_t)-Constant(4.0/dt/2.0)*inner(u_n,u_t)
-            +Constant(1.0/dt/2.0)*inner(u_1,u_t)
-            +Constant(2.0)*dot(dot(grad(u), u_n), u_t)
-            -dot(dot(grad(u), u_1), u_t)
+        # BDF2 / extrapolation coefficients are Constants, set_dt changes the step without rebuilding the forms
+        self.k0, self.k1, self.k2 = Constant(3.0/dt/2.0), Constant(4.0/dt/2.0), Constant(1.0/dt/2.0)
+        self.e0, self.e1 = Constant(2.0), Constant(1.0)
+        F = (self.k0*inner(u,u_t)-self.k1*inner(u_n,u_t)
+            +self.k2*inner(u_1,u_t)
+            +self.e0*dot(dot(grad(u), u_n), u_t)
+            -self.e1*dot(dot(grad(u), u_1), u_t)
             + mu*inner(grad(u), grad(u_t))
             - p*div(u_t)
             + p_t*div(u)
@@ -118,6 +184,65 @@ class MySolver:
         self.sol_n = sol_n
         self.sol_1 = sol_1
         self.u_t, self.p_t = u_t, p_t
+        self.dt, self.dt_prev, self.dt_next = dt, dt, dt
+        # new forms / functions invalidate the previously built solver
+        self.solver_ready = False
+
+    def set_dt(self, dt):
+        # variable step BDF2 with w = dt / dt_prev:
+        # ((1+2w)/(1+w) u - (1+w) u_n + w^2/(1+w) u_1) / dt, convection extrapolated with (1+w) u_n - w u_1
+        w = dt / self.dt_prev
+        self.k0.assign((1 + 2*w) / (1 + w) / dt)
+        self.k1.assign((1 + w) / dt)
+        self.k2.assign(w**2 / (1 + w) / dt)
+        self.e0.assign(1 + w)
+        self.e1.assign(w)
+        self.dt = dt
+
+    def cal_cfl(self, dt):
+        # max |u| dt / h_min over the velocity dofs
+        if not hasattr(self, 'u_dofs'):
+            V = self.function_space.V
+            self.u_dofs = (np.array(V.sub(0).sub(0).dofmap().dofs()), np.array(V.sub(0).sub(1).dofmap().dofs()))
+            self.h_min = self.geometry.mesh.hmin()
+        sol = self.sol.vector().get_local()
+        u_max = np.sqrt(sol[self.u_dofs[0]]**2 + sol[self.u_dofs[1]]**2).max()
+        return u_max * dt / self.h_min
+
+    def solve_adaptive(self, T, n_out=1):
+        """
+        Advance exactly T (one held control) with CFL-chosen steps, which may span several output steps.
+        <RETURN>
+        sols : list of n_out solution vectors at T * (j + 1) / n_out, quadratic interpolation of the
+               BDF2 states (sol_1, sol_n, sol) around each output time, the last one is sol itself
+        """
+        t, sols = 0, []
+        dt_max = T if self.dt_max is None else min(self.dt_max, T)
+        while T - t > 1e-10:
+            # split the rest of the hold evenly, keeping w close to 1
+            n = int(np.ceil((T - t) / min(self.dt_next, dt_max) - 1e-10))
+            dt = (T - t) / n
+            u_a = self.sol_1.vector().get_local()
+            self.set_dt(dt)
+            self.solve_step()
+            # nodes: t - dt_prev (u_a), t (sol_1 after the shift), t + dt (sol)
+            t_a, t_b, t_c = t - self.dt_prev, t, t + dt
+            u_b, u_c = self.sol_1.vector().get_local(), self.sol.vector().get_local()
+            while len(sols) < n_out and T * (len(sols) + 1) / n_out <= t_c + 1e-10:
+                s = T * (len(sols) + 1) / n_out
+                if abs(s - t_c) <= 1e-10:
+                    sols.append(u_c)
+                    continue
+                l_a = (s - t_b) * (s - t_c) / ((t_a - t_b) * (t_a - t_c))
+                l_b = (s - t_a) * (s - t_c) / ((t_b - t_a) * (t_b - t_c))
+                l_c = (s - t_a) * (s - t_b) / ((t_c - t_a) * (t_c - t_b))
+                sols.append(l_a * u_a + l_b * u_b + l_c * u_c)
+            self.dt_prev = dt
+            self.time += dt
+            t += dt
+            dt_cfl = self.cfl * dt / max(self.cal_cfl(dt), 1e-10)
+            self.dt_next = float(np.clip(dt_cfl, self.dt_min, max(self.dt_min, min(dt_max, 2 * self.dt_next))))
+        return sols
 
     def generate_solver(self):
         params = self.params
@@ -133,13 +258,28 @@ class MySolver:
         self.problem1 = problem1
 
         self.problem = problem
+        if self.linear is not None:
+            self.generate_linear_solver()
+        self.solver_ready = True
+
+    def generate_linear_solver(self):
+        # A / b are assembled into the same tensors every step, the sparsity pattern is kept and
+        # mumps only redoes the numeric factorization
+        a, L = system(replace(self.F, {self.sol: TrialFunction(self.function_space.V)}))
+        self.assembler = SystemAssembler(a, L, self.bcs)
+        self.A, self.b = PETScMatrix(), PETScVector()
+        self.assembler.assemble(self.A, self.b)
+        # the saddle point matrix has a zero pressure block, so ILU type preconditioners break down; a direct solve is kept
+        solver = PETScLUSolver('mumps')
+        solver.set_operator(self.A)
+        self.lin_solver = solver
         
     def set_sol_value(self, sol_value):
         self.sol.vector()[:] = sol_value
 
     def init_solve(self):       # dt T param
-        dt = 1e-4
-        T  = 1e-3
+        dt = self.params.get('init_dt', 1e-4)
+        T  = self.params.get('init_T', 1e-3)
         n_ts = int(-(T // -dt))
         self.generate_sol_var(dt)
         self.generate_solver()
@@ -152,7 +292,11 @@ class MySolver:
             self.time += dt
 
     def solve_step(self):
-        self.solver.solve()
+        if self.linear is not None:
+            self.assembler.assemble(self.A, self.b)
+            self.lin_solver.solve(self.sol.vector(), self.b)
+        else:
+            self.solver.solve()
         self.sol_1.vector()[:] = self.sol_n.vector()
         self.sol_n.vector()[:] = self.sol.vector()
 
@@ -17,7 +17,7 @@ import time
 class Cylinder_Rotation_Env(gym.Env):
     metadata = {'render.modes': ['human']}
 
-    def __init__(self, params=None):
+    def __init__(self, params=None, init_sol=None):
         self.set_params(params)
 
         self.action_space = spaces.Box(
@@ -32,7 +32,7 @@ class Cylinder_Rotation_Env(gym.Env):
             shape=(self.params['dimx'], self.params['dimy']),
             dtype=np.float32
         )
-        self.sim = Cylinder_Rotation_Sim(self.params)
+        self.sim = Cylinder_Rotation_Sim(self.params, init_sol)
         self.sim.generate_grid()
         self.sim.cal_mask()
         self.current_t = 0
@@ -66,6 +66,14 @@ class Cylinder_Rotation_Env(gym.Env):
         # episode_over = False
         return obs, C_D, C_L
 
+    def step_hold(self, action, n, mode='grid'):
+        # action held for n steps: obs [n, nx, ny, 5], C_D [n], C_L [n]. In adaptive mode the solver steps
+        # may span several of them and the observations are interpolated at the fixed cadence
+        sols = self.sim.do_simulation(action, n)
+        obs = np.stack([self.sim.get_observation(mode, sol) for sol in sols])
+        C_D, C_L, _ = np.array([self.sim.postprocess(sol) for sol in sols]).T
+        return obs, C_D, C_L
+
     def reset(self, mode='grid'):
         # self.sim.set_state_vector(self.sim.init_state_1_vector.vector())
         self.sim.reset_state_vector()
@@ -73,9 +81,20 @@ class Cylinder_Rotation_Env(gym.Env):
         # print('env reset complete')
         return self.sim.get_observation(mode)
 
+    def snapshot(self):
+        snap = self.sim.snapshot()
+        snap['current_t'] = self.current_t
+        return snap
+
+    def restore(self, snap, mode='grid'):
+        self.sim.restore(snap)
+        self.current_t = snap['current_t']
+        return self.sim.get_observation(mode)
+
     def set_init(self):
         self.sim.save_sol()  
-        self.sim.set_init_vector(self.sim.log_sol_1, self.sim.log_sol_n)   
+        self.sim.set_init_vector(self.sim.log_sol_1, self.sim.log_sol_n, self.sim.log_dt)
+        self.sim.reset_state_vector()   
 
     def _render(self, mode='grid', obj='u', close=False):
         if mode == 'grid':
@@ -1,19 +1,24 @@
 from CFD import MyGeometry, MyFunctionSpace, MySolver   
 import copy
+import hashlib
+import os
 from fenics import *
+from ffc.fiatinterface import create_element
 import numpy as np
+import scipy.sparse as sp
 import matplotlib.pyplot as plt
 from matplotlib import  cm
 import matplotlib.tri as tri
 set_log_level(30)
 
 class Cylinder_Rotation_Sim:
-    def __init__(self,  params):
+    def __init__(self,  params, init_sol=None):
+        # init_sol: (sol_1, sol_n) or (sol_1, sol_n, dt) vectors of a precomputed start, skips init_solve
 
         min_x, max_x, min_y, max_y = params['min_x'], params['max_x'], params['min_y'], params['max_y']
         r, center = params['r'], params['center']
         dt = params['dt']
-        geometry = MyGeometry(min_x = min_x, max_x = max_x, min_y = min_y,max_y = max_y, r = r, center=center)
+        geometry = MyGeometry(min_x = min_x, max_x = max_x, min_y = min_y,max_y = max_y, r = r, center=center, params=params)
         function_space = MyFunctionSpace(geometry, )
         solver = MySolver(geometry, function_space, params=params)
         
@@ -31,31 +36,55 @@ class Cylinder_Rotation_Sim:
         self.solver.changeable_boundary_conditions(ang_vel=0.0000, )
         self.solver.generate_bc()
         # self.solver.changeable_boundary_conditions(ang_vel=0, )
-        print("start init_solve")
-        self.solver.init_solve()
-        print("end init_solve")
         self.init_sol_1 = Function(self.function_space.V)
-        self.init_sol_1.vector()[:] = solver.sol_1.vector()
         self.init_sol_n = Function(self.function_space.V)
-        self.init_sol_n.vector()[:] = solver.sol_n.vector()
+        if init_sol is None:
+            print("start init_solve")
+            self.solver.init_solve()
+            print("end init_solve")
+            self.init_sol_1.vector()[:] = solver.sol_1.vector()
+            self.init_sol_n.vector()[:] = solver.sol_n.vector()
+            self.init_dt = dt
+        else:
+            self.set_init_vector(*init_sol)
         self.solver.generate_sol_var(dt)
         # self.init_state_1_vector =   solver.sol.vector()
     
     def set_state_funcval(self, initu, initp):
         assign(self.solver.sol, [initu, initp])
     
-    def set_init_vector(self, init_sol_1, init_sol_n):
+    def set_init_vector(self, init_sol_1, init_sol_n, init_dt=None):
+        # init_dt: step between sol_1 and sol_n, the last substep in adaptive mode
         self.init_sol_1.vector()[:] = init_sol_1
         self.init_sol_n.vector()[:] = init_sol_n
+        self.init_dt = self.params['dt'] if init_dt is None else init_dt
     
     def save_sol(self):
-        self.log_sol_1 = self.solver.sol_1.vector()
-        self.log_sol_n = self.solver.sol_n.vector()
+        self.log_sol_1 = self.solver.sol_1.vector().copy()
+        self.log_sol_n = self.solver.sol_n.vector().copy()
+        self.log_dt = self.solver.dt_prev
+
+    def snapshot(self):
+        # copy of the full solver state, restore() brings the simulation back to it
+        return {'sol': self.solver.sol.vector().get_local(),
+                'sol_n': self.solver.sol_n.vector().get_local(),
+                'sol_1': self.solver.sol_1.vector().get_local(),
+                'time': self.solver.time,
+                'dt': (self.solver.dt_prev, self.solver.dt_next)}
+
+    def restore(self, snap):
+        self.solver.sol.vector()[:] = snap['sol']
+        self.solver.sol_n.vector()[:] = snap['sol_n']
+        self.solver.sol_1.vector()[:] = snap['sol_1']
+        self.solver.time = snap['time']
+        self.solver.dt_prev, self.solver.dt_next = snap['dt']
 
     def reset_state_vector(self):
         self.solver.sol.vector()[:] = self.init_sol_n.vector()
         self.solver.sol_1.vector()[:] = self.init_sol_1.vector()
         self.solver.sol_n.vector()[:] = self.init_sol_n.vector()
+        # BDF2 weights of the first step follow the spacing of the restored sol_1 / sol_n
+        self.solver.dt_prev, self.solver.dt_next = self.init_dt, self.init_dt
 
     def generate_init_state(self, init_state=(  ('0', '0'), '0')):
                                                 # (Constant(0)) )):
@@ -65,12 +94,17 @@ class Cylinder_Rotation_Sim:
   
         return (initu, initp)
     
-    def do_simulation(self, ang_vel=0 ):
-        self.solver.changeable_boundary_conditions(ang_vel=ang_vel, )
-        self.solver.generate_bc()
-        self.solver.generate_solver()
+    def do_simulation(self, ang_vel=0, n_out=1):
+        # ang_vel held for n_out steps of params['dt'], returns the solution vectors at the n_out output times
+        self.solver.update_solver(ang_vel)
         # self.solver.generate_sol_var()
-        self.solver.solve_step()
+        if self.solver.adaptive:
+            return self.solver.solve_adaptive(n_out * self.params['dt'], n_out)
+        sols = []
+        for i in range(n_out):
+            self.solver.solve_step()
+            sols.append(self.solver.sol.vector().get_local())
+        return sols
 
     def get_state(self):
         return self.solver.sol.vector()
@@ -81,8 +115,11 @@ class Cylinder_Rotation_Sim:
     # if mode == 'node':
             # current_obs = self.solver.sol.vector().get_local()
  
-    def get_observation(self, mode):
+    def get_observation(self, mode, sol=None):
+        # sol: solution vector to observe (e.g. interpolated by do_simulation), default the current state
         if mode == 'vertex':
+            if sol is not None:
+                raise ValueError('vertex observations are only available at the current state')
             vertex_obs = self.solver.sol.compute_vertex_values()
             nv = self.solver.geometry.num_vertices
              
@@ -90,16 +127,9 @@ class Cylinder_Rotation_Sim:
             self.observation_mode = 'vertex'
 
         elif mode == 'grid':
-            out = np.zeros((*self.grids.shape[:2],3))
-            for i in range(self.grids.shape[0]):
-                for j in range(self.grids.shape[1]):
-                    xy = self.grids[i, j]
-                    center = self.params['center']
-                    r = self.params['r']
-                    if np.linalg.norm(xy - center) > r:
-                        out[i, j] = self.solver.sol(xy)         # sol & sol_n
-                    else:
-                        out[i, j] = 0
+            # one sparse mat-vec: rows of cylinder / out-of-domain points are empty -> 0
+            out = self.interp @ (self.solver.sol.vector().get_local() if sol is None else sol)
+            out = out.reshape(*self.grids.shape[:2], 3)
             self.current_obs = np.concatenate([self.grids, out], axis=-1)
             # self.current_obs = out
             self.observation_mode = 'grid'
@@ -118,6 +148,84 @@ class Cylinder_Rotation_Sim:
         grids = np.stack((mx, my), 2)
         self.grids = grids
         self.meshgrid = [mx, my]
+        if not self.load_grid_cache():
+            self.cal_interp()
+            self.save_grid_cache()
+
+    def grid_cache_path(self):
+        # keyed by mesh, grid dims and domain bounds
+        mesh = self.geometry.mesh
+        key = hashlib.md5()
+        key.update(np.ascontiguousarray(mesh.coordinates()).tobytes())
+        key.update(np.ascontiguousarray(mesh.cells()).tobytes())
+        key.update(np.array([self.params['dimx'], self.params['dimy']]).tobytes())
+        key.update(np.array([self.params['min_x'], self.params['max_x'], self.params['min_y'], self.params['max_y'],
+                             self.params['r'], *self.params['center']], dtype=np.float64).tobytes())
+        cache_dir = self.params.get('cache_dir', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache'))
+        return os.path.join(cache_dir, f'grid_{key.hexdigest()}.npz')
+
+    def load_grid_cache(self):
+        path = self.grid_cache_path()
+        if not os.path.exists(path):
+            return False
+        cache = np.load(path)
+        self.out_mask = cache['out_mask']
+        self.interp = sp.csr_matrix((cache['data'], cache['indices'], cache['indptr']), shape=tuple(cache['shape']))
+        return True
+
+    def save_grid_cache(self):
+        path = self.grid_cache_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so concurrent workers never read a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, out_mask=self.out_mask, data=self.interp.data, indices=self.interp.indices,
+                 indptr=self.interp.indptr, shape=np.array(self.interp.shape))
+        os.replace(tmp_path, path)
+
+    def cal_interp(self):
+        # sparse operator (dimx * dimy * 3, V.dim()) mapping sol.vector() to (u, v, p) on the grid
+        V = self.function_space.V
+        mesh = self.geometry.mesh
+        dofmap = V.dofmap()
+        tree = mesh.bounding_box_tree()
+        value_dim = V.element().value_dimension(0)
+        center = np.array(self.params['center'])
+        r = self.params['r']
+        coords, cells = mesh.coordinates(), mesh.cells()
+
+        # cell of every grid point in one pass, the bounding box tree is only asked for the misses
+        # (points on the outer boundary can fall between the trapezoids)
+        points = self.grids.reshape(-1, 2)
+        cell_ids = tri.Triangulation(coords[:, 0], coords[:, 1], cells).get_trifinder()(points[:, 0], points[:, 1])
+        for k in np.where(cell_ids < 0)[0]:
+            cell_id = tree.compute_first_entity_collision(Point(*points[k]))
+            cell_ids[k] = cell_id if cell_id < mesh.num_cells() else -1
+
+        # the cylinder polygon is inscribed in the circle, so only points in the disk may miss the mesh
+        in_cylinder = np.linalg.norm(points - center, axis=-1) <= r
+        lost = (cell_ids < 0) & ~in_cylinder
+        if lost.any():
+            raise ValueError(f'{lost.sum()} grid points outside the cylinder miss the mesh, e.g. {points[lost][0]}')
+        self.out_mask = ((cell_ids < 0) & in_cylinder).reshape(self.grids.shape[:2])
+
+        # basis values of the points outside the disk: reference coordinates of the affine cells,
+        # tabulated at once on the reference element (Lagrange, so no Piola map)
+        idx = np.where(~in_cylinder)[0]
+        vert = coords[cells[cell_ids[idx]]]                                 # (n, 3, 2)
+        J = np.stack((vert[:, 1] - vert[:, 0], vert[:, 2] - vert[:, 0]), -1)  # (n, 2, 2)
+        ref = np.linalg.solve(J, (points[idx] - vert[:, 0])[..., None])[..., 0]
+        basis = create_element(V.ufl_element()).tabulate(0, ref)[(0, 0)]     # (n_dofs, value_dim, n)
+
+        # dofs only for the cells that hold points
+        hosts, inverse = np.unique(cell_ids[idx], return_inverse=True)
+        dofs = np.array([dofmap.cell_dofs(c) for c in hosts])[inverse]      # (n, n_dofs)
+
+        rows = (idx[:, None] * value_dim + np.arange(value_dim))[:, :, None]  # (n, value_dim, 1)
+        rows = np.broadcast_to(rows, (idx.shape[0], value_dim, dofs.shape[1]))
+        cols = np.broadcast_to(dofs[:, None, :], rows.shape)
+        vals = basis.transpose(2, 1, 0)
+        shape = (points.shape[0] * value_dim, V.dim())
+        self.interp = sp.csr_matrix((vals.ravel(), (rows.ravel(), cols.ravel())), shape=shape)
 
     def get_mask(self, mode):
         if mode == 'raw':
@@ -126,53 +234,56 @@ class Cylinder_Rotation_Sim:
             return (self.zero_mask_argument, self.non_zero_mask_argument)
 
     def cal_mask(self):
-        grids = self.grids
-        out = np.zeros(grids.shape[:2])
-        for i in range(grids.shape[0]):
-            for j in range(grids.shape[1]):
-                xy = grids[i, j]
-                try:
-                    self.solver.sol(xy)
-                except RuntimeError:
-                    out[i, j] = 1
- 
-        out_argument  = out.copy()
-        x,y = np.where(out_argument ==1)
-        for i in range(x.shape[0]):
-            out_argument[x[i], y[i]] = 1
-            out_argument[x[i]-1, y[i]] = 1
-            out_argument[x[i]+1, y[i]] = 1
-            out_argument[x[i], y[i]-1] = 1
-            out_argument[x[i], y[i]+1] = 1
-        self.zero_mask_argument = out_argument == 1
-        self.non_zero_mask_argument = out_argument == 0
-
-        out_raw = out.copy()
-        self.zero_mask = out_raw == 1
-        self.non_zero_mask = out_raw == 0
+        out = self.out_mask
+
+        # dilate by one grid point in x and y
+        out_argument = out.copy()
+        out_argument[1:] |= out[:-1]
+        out_argument[:-1] |= out[1:]
+        out_argument[:, 1:] |= out[:, :-1]
+        out_argument[:, :-1] |= out[:, 1:]
+        self.zero_mask_argument = out_argument
+        self.non_zero_mask_argument = ~out_argument
+
+        self.zero_mask = out.copy()
+        self.non_zero_mask = ~out
     
-    def postprocess(self, sol):
-        u, p = sol.split()
+    def cal_force(self):
+        # C_D, C_L and p_diff are linear in sol: one (3, V.dim()) operator, assembled once
+        V = self.function_space.V
+        mesh = self.geometry.mesh
         mu = self.params['mu']
+        U_mean = self.params['U_max']* 2/3
+        L = 2* self.params['r']
+        scale = 2/(U_mean**2*L)
+
+        # drag & lift: the force functional with sol replaced by a test function
+        u, p = split(TestFunction(V))
         ds_circle = Measure("ds", subdomain_data=self.solver.geometry.bndry, subdomain_id=5)
-        # Report drag and lift
-        n = FacetNormal(sol.function_space().mesh())
+        n = FacetNormal(mesh)
         force = -p*n +  mu *dot(grad(u), n)
-        F_D = assemble(-force[0]*ds_circle)
-        F_L = assemble(-force[1]*ds_circle)
+        op = np.zeros((3, V.dim()))
+        op[0] = scale * assemble(-force[0]*ds_circle).get_local()
+        op[1] = scale * assemble(-force[1]*ds_circle).get_local()
 
-        U_mean = self.params['U_max']* 2/3
-        L = 2* self.params['r']
-        C_D = 2/(U_mean**2*L)*F_D
-        C_L = 2/(U_mean**2*L)*F_L
-
-        # Report pressure difference
-        a_1 = Point(0.15, 0.2)
-        a_2 = Point(0.25, 0.2)
-        try:
-            p_diff = p(a_1) - p(a_2)
-        except RuntimeError:
-            p_diff = 0
+        # pressure difference: p(a_1) - p(a_2) from the basis functions at both points
+        element = V.element()
+        tree = mesh.bounding_box_tree()
+        for xy, sign in [((0.15, 0.2), 1), ((0.25, 0.2), -1)]:
+            cell_id = tree.compute_first_entity_collision(Point(*xy))
+            if cell_id >= mesh.num_cells():
+                op[2] = 0
+                break
+            cell = Cell(mesh, cell_id)
+            basis = element.evaluate_basis_all(np.array(xy), cell.get_vertex_coordinates(), cell.orientation())
+            op[2, V.dofmap().cell_dofs(cell_id)] += sign * basis.reshape(-1, element.value_dimension(0))[:, 2]
+        self.force_op = op
+
+    def postprocess(self, sol):
+        if not hasattr(self, 'force_op'):
+            self.cal_force()
+        # sol: Function or solution vector
+        C_D, C_L, p_diff = self.force_op @ (sol if isinstance(sol, np.ndarray) else sol.vector().get_local())
 
         return C_D, C_L, p_diff
 
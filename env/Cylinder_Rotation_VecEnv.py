@@ -0,0 +1,135 @@
+import numpy as np
+import multiprocessing as mp
+import traceback
+from gym import spaces
+
+from Cylinder_Rotation_Env import Cylinder_Rotation_Env
+
+
+def worker(remote, idx, params, init_sol, obs_buf, mode):
+    # one env per process, observations are written into slot idx of the shared buffer
+    # every reply is ('ok', result) or ('error', traceback), so a failed solve (e.g. Newton divergence)
+    # is raised in the parent instead of leaving it waiting
+    try:
+        env = Cylinder_Rotation_Env(params, init_sol)
+    except Exception:
+        remote.send(('error', traceback.format_exc()))
+        remote.close()
+        return
+    obs_buf = np.frombuffer(obs_buf, dtype=np.float64).reshape(-1, params['dimx'], params['dimy'], 5)
+    while True:
+        cmd, data = remote.recv()
+        if cmd == 'close':
+            remote.close()
+            break
+        try:
+            if cmd == 'step':
+                obs_buf[idx], C_D, C_L = env.step(data, mode)
+                remote.send(('ok', (C_D, C_L)))
+            elif cmd == 'reset':
+                obs_buf[idx] = env.reset(mode)
+                remote.send(('ok', None))
+        except Exception:
+            remote.send(('error', traceback.format_exc()))
+
+
+class Cylinder_Rotation_VecEnv:
+    """
+    N Cylinder_Rotation_Env in worker processes with batched step / reset.
+    The mesh, grid interpolation and init solve are done once here: workers read the grid cache
+    and start from the broadcast init state. Grid observations come back through shared memory.
+    """
+    def __init__(self, num_envs, params=None, T_init=0, copy=True, timeout=600):
+        # T_init: uncontrolled warm-up time of the shared start state
+        # copy: return a copy of the shared observation buffer, it is overwritten by the next step
+        # timeout: seconds to wait for a worker reply, None waits as long as the worker is alive
+        self.num_envs = num_envs
+        self.copy = copy
+        self.timeout = timeout
+        self.mode = 'grid'
+
+        env = Cylinder_Rotation_Env(params)
+        self.params = env.params
+        env.reset()
+        for i in range(int(T_init / self.params['dt'])):
+            env.step(0.00)
+        env.set_init()
+        init_sol = (env.sim.log_sol_1.get_local(), env.sim.log_sol_n.get_local(), env.sim.log_dt)
+        self.single_action_space = env.action_space
+        self.action_space = spaces.Box(low=self.params['min_w'], high=self.params['max_w'],
+                                       shape=(num_envs, 1), dtype=np.float32)
+        del env
+
+        nx, ny = self.params['dimx'], self.params['dimy']
+        # spawn: fenics / MPI state does not survive fork
+        ctx = mp.get_context('spawn')
+        self.obs_buf = ctx.RawArray('d', num_envs * nx * ny * 5)
+        self.obs = np.frombuffer(self.obs_buf, dtype=np.float64).reshape(num_envs, nx, ny, 5)
+        self.remotes, self.processes = [], []
+        for idx in range(num_envs):
+            remote, work_remote = ctx.Pipe()
+            p = ctx.Process(target=worker, args=(work_remote, idx, self.params, init_sol, self.obs_buf, self.mode), daemon=True)
+            p.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(p)
+
+    def recv(self, idx):
+        # poll in short slices so a dead worker (crash, kill) is noticed, not only a timeout;
+        # after a timeout a late reply may still be queued, close the VecEnv rather than stepping on
+        remote, p = self.remotes[idx], self.processes[idx]
+        waited = 0
+        while not remote.poll(1):
+            waited += 1
+            if not p.is_alive():
+                raise RuntimeError(f'env worker {idx} died (exit code {p.exitcode})')
+            if self.timeout is not None and waited >= self.timeout:
+                raise TimeoutError(f'env worker {idx} did not reply within {self.timeout}s')
+        status, result = remote.recv()
+        if status == 'error':
+            raise RuntimeError(f'env worker {idx} failed:\n{result}')
+        return result
+
+    def recv_all(self):
+        # every worker is read before raising, so the replies of the others are not left in the pipes
+        results, errors = [], []
+        for idx in range(self.num_envs):
+            try:
+                results.append(self.recv(idx))
+            except (RuntimeError, TimeoutError) as e:
+                results.append(None)
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def get_obs(self):
+        return self.obs.copy() if self.copy else self.obs
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(('reset', None))
+        self.recv_all()
+        return self.get_obs()
+
+    def step_async(self, actions):
+        for remote, action in zip(self.remotes, np.asarray(actions).reshape(self.num_envs)):
+            remote.send(('step', float(action)))
+
+    def step_wait(self):
+        C_D, C_L = np.array(self.recv_all()).T
+        return self.get_obs(), C_D, C_L
+
+    def step(self, actions):
+        # actions: [num_envs] -> obs [num_envs, nx, ny, 5], C_D [num_envs], C_L [num_envs]
+        self.step_async(actions)
+        return self.step_wait()
+
+    def close(self):
+        for remote, p in zip(self.remotes, self.processes):
+            if p.is_alive():
+                remote.send(('close', None))
+        for p in self.processes:
+            p.join(timeout=self.timeout)
+            if p.is_alive():
+                p.terminate()
@@ -0,0 +1,59 @@
+import numpy as np
+import argparse
+from timeit import default_timer
+
+from Cylinder_Rotation_Env import Cylinder_Rotation_Env
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Put your hyperparameters')
+    parser.add_argument('-dt', '--dt', default=0.01, type=float, help='time step of the env')
+    parser.add_argument('-Ti', '--T_init', default=4, type=float, help='uncontrolled warm-up time')
+    parser.add_argument('-n', '--n_steps', default=100, type=int, help='timed steps')
+
+    return parser.parse_args(argv)
+
+def make_env(dt, linear_solve=None, init_sol=None):
+    return Cylinder_Rotation_Env(init_sol=init_sol, params={'dt': dt, 'rho_0': 1, 'mu' : 1/1000,
+                                                            'traj_max_T': 20, 'dimx': 256, 'dimy': 64,
+                                                            'min_x' : 0,  'max_x' : 2.2,
+                                                            'min_y' : 0,  'max_y' : 0.41,
+                                                            'r' : 0.05,  'center':(0.2, 0.2),
+                                                            'min_w': -1, 'max_w': 1,
+                                                            'min_velocity': -1, 'max_velocity': 1,
+                                                            'U_max': 1.5, 'linear_solve': linear_solve})
+
+def bench(env, f):
+    # per step time of the solve alone (do_simulation) and the observed Cd / Cl
+    t, C_D, C_L = np.zeros(len(f)), np.zeros(len(f)), np.zeros(len(f))
+    for i in range(len(f)):
+        t1 = default_timer()
+        env.sim.do_simulation(f[i])
+        t[i] = default_timer() - t1
+        _, C_D[i], C_L[i] = env._get_reward()
+    return t, C_D, C_L
+
+if __name__ == '__main__':
+    args = get_args()
+
+    # both solvers start from the same developed flow
+    env = make_env(args.dt)
+    env.reset()
+    for i in range(int(args.T_init / args.dt)):
+        env.step(0.00)
+    env.set_init()
+    init_sol = (env.sim.log_sol_1.get_local(), env.sim.log_sol_n.get_local(), env.sim.log_dt)
+
+    f = np.sin(np.linspace(0, 2 * np.pi, args.n_steps))
+    logs = dict()
+    for name, linear_solve in [('newton', None), ('lu', 'lu')]:
+        env = make_env(args.dt, linear_solve, init_sol)
+        env.reset()
+        # the first step builds the solver (and factorization pattern), it is not timed
+        env.sim.do_simulation(f[0])
+        logs[name] = bench(env, f[1:])
+        print(f'{name} | step: mean {logs[name][0].mean():1.4f}s | max {logs[name][0].max():1.4f}s')
+
+    t_newton, t_lu = logs['newton'][0].mean(), logs['lu'][0].mean()
+    print(f'speedup: {t_newton / t_lu:1.2f}')
+    print(f'max abs diff | C_D: {np.abs(logs["lu"][1] - logs["newton"][1]).max():1.2e}\
+          | C_L: {np.abs(logs["lu"][2] - logs["newton"][2]).max():1.2e}')
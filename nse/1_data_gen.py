@@ -4,10 +4,12 @@ sys.path.append("../env")
 
 from env.Cylinder_Rotation_Env import Cylinder_Rotation_Env
 import numpy as np
-import matplotlib.pyplot as plt 
+import matplotlib.pyplot as plt
 import torch
-from fenics import * 
+import multiprocessing as mp
+from fenics import *
 from timeit import default_timer
+from scripts.utils import TrajWriter
 
 import argparse
 
@@ -19,99 +21,154 @@ def get_args(argv=None):
     parser.add_argument('-fb', '--f_base', default=0, type=float)
     parser.add_argument('-dt', '--dt', default=0.01, type=float)
     parser.add_argument('-Nf', '--Nf', default=8, type=int)
+    parser.add_argument('-nw', '--num_workers', default=1, type=int, help='number of simulation processes')
+    parser.add_argument('--resume', action='store_true', help='skip the (k, l) trajectories already written')
+    parser.add_argument('--adaptive_dt', action='store_true', help='CFL-chosen solver steps, observations interpolated every dt')
 
     return parser.parse_args(argv)
 
-print('start')
-args = get_args()
-
-# env init
-env = Cylinder_Rotation_Env(params={'dt': args.dt, 'rho_0': 1, 'mu' : 1/1000,
-                                    'traj_max_T': 20, 'dimx': 256, 'dimy': 64,
-                                    'min_x' : 0,  'max_x' : 2.2, 
-                                    'min_y' : 0,  'max_y' : 0.41, 
-                                    'r' : 0.05,  'center':(0.2, 0.2),
-                                    'min_w': -1, 'max_w': 1,
-                                    'min_velocity': -1, 'max_velocity': 1,
-                                    'U_max': 1.5, })
-
-# env params
-print(env.params)
-
-# param setting
-dt = env.params['dt']
-Tr = args.Tr
-nT = int (Tr / dt)
-hf_nT = int(nT / 2)
-nx = env.params['dimx']
-ny = env.params['dimy']
-print(f'dt: {dt} | nt: {nT}')
-
-# data generate
-Nf = args.Nf + 1
-fr = args.f_range
-fb = args.f_base
-f1 = np.linspace(-fr + fb, fr + fb, Nf)
-f2 = np.linspace(-fr + fb, fr + fb, Nf)
-print(f'f1: {f1}')
-print(f'f2: {f2}')
-N0 = Nf * Nf
-obs = np.zeros((N0, nT+1, nx, ny, 5))
-print(f'state_data_size :{obs.shape}')
-f = np.zeros((N0, nT))
-C_D, C_L = np.zeros((N0, nT)), np.zeros((N0, nT))
-
-# env init step
-start = default_timer()
-nT_init = int(4 / dt)
-for i in range(nT_init):
-    env.step(0.00)
-end = default_timer()
-print(f'init complete: {end - start}')
-
-env.set_init()
-# obs_temp = env.reset(mode='vertex')
-# obs_temp = env.reset(mode='grid')
-# mesh_num = obs_temp.shape[0]
-# obs_v = np.zeros((N0, nT+1, mesh_num, 5))
-
-for k in range(Nf):
-    for l in range(Nf):
-        print(f'start # {Nf * k + l + 1}')
-        start = default_timer()
-
-        # obs_v[Nf * k + l, 0] = env.reset(mode='vertex')
-        obs[Nf * k + l, 0] = env.reset(mode='grid')
-    
-        for i in range(hf_nT):
-            f[Nf * k + l, i] = f1[k]
-            obs[Nf * k + l, i+1], C_D[Nf * k + l, i], C_L[Nf * k + l, i] = env.step(f[Nf * k + l, i])
-            # obs_v[Nf * k + l, i+1], C_D[Nf * k + l, i], C_L[Nf * k + l, i] = env.step(f1[k], mode='vertex')
-        
-        for i in range(hf_nT, nT):
-            f[Nf * k + l, i] = f2[l]
-            obs[Nf * k + l, i+1], C_D[Nf * k + l, i], C_L[Nf * k + l, i] = env.step(f[Nf * k + l, i])
-            # obs_v[Nf * k + l, i+1], C_D[Nf * k + l, i], C_L[Nf * k + l, i] = env.step(f2[l], mode='vertex')
-    
-        end = default_timer()
-
-        print(f'end # {Nf * k + l + 1} | time: {end-start}')
-    # print(f'ang_vel: {ang_v}')
-    # print(f'reward :{reward[k]}')
-
-# np to tensor
-obs_tensor = torch.Tensor(obs)
-# obs_v_tensor = torch.Tensor(obs_v)
-C_D_tensor = torch.Tensor(C_D)
-C_L_tensor = torch.Tensor(C_L)
-ctr_tensor = torch.Tensor(f)
-
-data = [obs_tensor, C_D_tensor, C_L_tensor, ctr_tensor]
-# data_v = [obs_v_tensor, C_D_tensor, C_L_tensor, f_tensor]
-
-# save data
-# torch.save(data, './data/nse_data_N0_{}_nT_{}_f1_{}_f2_{}'.format(N0, nT, args.f1, args.f2))
-# torch.save(data_v, './data/nse_data_irr')
-torch.save(data, f'./data/nse_data_reg_dt_{dt}_fb_{args.f_base}_fr_{args.f_range}')
-# torch.save(data, f'./data/test_data/nse_data_reg_scale_{args.scale}_{args.data_name}')
-# torch.save(data, './data/nse_data_test1')
\ No newline at end of file
+def make_env(dt, init_sol=None, adaptive_dt=False):
+    # init_sol: broadcast (sol_1, sol_n, dt) start state, skips init_solve
+    return Cylinder_Rotation_Env(init_sol=init_sol, params={'dt': dt, 'rho_0': 1, 'mu' : 1/1000, 'adaptive_dt': adaptive_dt,
+                                         'traj_max_T': 20, 'dimx': 256, 'dimy': 64,
+                                         'min_x' : 0,  'max_x' : 2.2,
+                                         'min_y' : 0,  'max_y' : 0.41,
+                                         'r' : 0.05,  'center':(0.2, 0.2),
+                                         'min_w': -1, 'max_w': 1,
+                                         'min_velocity': -1, 'max_velocity': 1,
+                                         'U_max': 1.5, })
+
+# each process owns one env
+env = None
+
+def init_worker(dt, init_sol, adaptive_dt):
+    # the warmed-up state is computed once in the main process and broadcast here
+    global env
+    env = make_env(dt, init_sol, adaptive_dt)
+
+def gen_prefix(job):
+    # the f1 half is simulated once, written into every pending (k, l) trajectory and snapshotted for the branches
+    k, f1_k, idxs, hf_nT, traj_path = job
+    writer = TrajWriter(traj_path)
+    obs = writer['obs']
+    obs_1 = np.zeros((hf_nT + 1, *obs.shape[2:]))
+
+    start = default_timer()
+    obs_1[0] = env.reset(mode='grid')
+    # f1_k is held for the whole prefix, adaptive steps may span several output steps
+    obs_1[1:], C_D_1, C_L_1 = env.step_hold(f1_k, hf_nT)
+    obs[idxs, :hf_nT+1] = obs_1
+    obs.flush()
+    end = default_timer()
+
+    return k, (env.snapshot(), C_D_1, C_L_1), end - start
+
+def gen_branch(job):
+    # f2 half of trajectory idx, restarted from the snapshot of its f1 prefix
+    idx, f1_k, f2_l, prefix, hf_nT, nT, traj_path = job
+    snap, C_D_1, C_L_1 = prefix
+    writer = TrajWriter(traj_path)
+    obs = writer['obs']
+    f = np.zeros(nT)
+    C_D, C_L = np.zeros(nT), np.zeros(nT)
+    f[:hf_nT], C_D[:hf_nT], C_L[:hf_nT] = f1_k, C_D_1, C_L_1
+
+    start = default_timer()
+    env.restore(snap)
+    f[hf_nT:] = f2_l
+    obs[idx, hf_nT+1:], C_D[hf_nT:], C_L[hf_nT:] = env.step_hold(f2_l, nT - hf_nT)
+    writer.write(idx, C_D=C_D, C_L=C_L, ctr=f)
+    obs.flush()
+    end = default_timer()
+
+    return idx, end - start
+
+if __name__ == '__main__':
+    print('start')
+    args = get_args()
+
+    # env init
+    env = make_env(args.dt, adaptive_dt=args.adaptive_dt)
+
+    # env params
+    print(env.params)
+
+    # param setting
+    dt = env.params['dt']
+    Tr = args.Tr
+    nT = int (Tr / dt)
+    hf_nT = int(nT / 2)
+    nx = env.params['dimx']
+    ny = env.params['dimy']
+    print(f'dt: {dt} | nt: {nT}')
+
+    # data generate
+    Nf = args.Nf + 1
+    fr = args.f_range
+    fb = args.f_base
+    f1 = np.linspace(-fr + fb, fr + fb, Nf)
+    f2 = np.linspace(-fr + fb, fr + fb, Nf)
+    print(f'f1: {f1}')
+    print(f'f2: {f2}')
+    N0 = Nf * Nf
+    # shared output: every process streams its trajectories straight into these files
+    data_path = f'./data/nse_data_reg_dt_{dt}_fb_{args.f_base}_fr_{args.f_range}'
+    traj_path = data_path + '_traj'
+    writer = TrajWriter(traj_path, {'obs': (N0, nT+1, nx, ny, 5), 'C_D': (N0, nT), 'C_L': (N0, nT), 'ctr': (N0, nT)},
+                        resume=args.resume)
+    print(f'state_data_size :{writer["obs"].shape}')
+
+    # env init step
+    start = default_timer()
+    nT_init = int(4 / dt)
+    for i in range(nT_init):
+        env.step(0.00)
+    end = default_timer()
+    print(f'init complete: {end - start}')
+
+    env.set_init()
+    # same (sol_1, sol_n, dt) as Cylinder_Rotation_VecEnv, workers start with the dt_prev of the serial path
+    init_sol = (env.sim.log_sol_1.get_local(), env.sim.log_sol_n.get_local(), env.sim.log_dt)
+
+    # f1 prefixes first, every pending f2 branch becomes its own job as soon as its prefix snapshot exists
+    pending = {k: [(Nf * k + l, f2[l]) for l in range(Nf) if not writer.is_done(Nf * k + l)] for k in range(Nf)}
+    prefix_jobs = [(k, f1[k], [idx for idx, _ in branches], hf_nT, traj_path) for k, branches in pending.items() if len(branches) > 0]
+    print(f'trajectories to generate: {sum(len(branches) for branches in pending.values())} / {N0}')
+    if args.num_workers > 1:
+        # spawn: fenics / MPI state does not survive fork
+        ctx = mp.get_context('spawn')
+        pool = ctx.Pool(args.num_workers, initializer=init_worker, initargs=(dt, init_sol, args.adaptive_dt))
+        prefixes = pool.imap_unordered(gen_prefix, prefix_jobs)
+    else:
+        pool = None
+        prefixes = map(gen_prefix, prefix_jobs)
+
+    branch_results = []
+    for k, prefix, t in prefixes:
+        print(f'prefix # {k} | time: {t}')
+        for idx, f2_l in pending[k]:
+            job = (idx, f1[k], f2_l, prefix, hf_nT, nT, traj_path)
+            branch_results.append(pool.apply_async(gen_branch, (job,)) if pool is not None else gen_branch(job))
+
+    for res in branch_results:
+        idx, t = res.get() if pool is not None else res
+        writer.commit(idx)
+        print(f'end # {idx + 1} | time: {t}')
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # np to tensor (views of the memory-mapped files)
+    obs_tensor = writer.to_tensor('obs')
+    C_D_tensor = writer.to_tensor('C_D')
+    C_L_tensor = writer.to_tensor('C_L')
+    ctr_tensor = writer.to_tensor('ctr')
+
+    data = [obs_tensor, C_D_tensor, C_L_tensor, ctr_tensor]
+
+    # save data
+    # torch.save(data, './data/nse_data_N0_{}_nT_{}_f1_{}_f2_{}'.format(N0, nT, args.f1, args.f2))
+    torch.save(data, data_path)
+    # torch.save(data, f'./data/test_data/nse_data_reg_scale_{args.scale}_{args.data_name}')
+    # torch.save(data, './data/nse_data_test1')
@@ -10,7 +10,13 @@ import torch
 from timeit import default_timer
 import math
 import torch.nn as nn
+import argparse
 from env.RBC_env import RBC
+from scripts.utils import TrajWriter
+
+parser = argparse.ArgumentParser(description='Put your hyperparameters')
+parser.add_argument('--resume', action='store_true', help='skip the (k, l) trajectories already written')
+args = parser.parse_args()
 
 params = {'dt':  0.05, 'T':  0.01, 'dimx': 64, 'dimy': 32, 'min_x' : 0, 'max_x' : 2.0, 'min_y' : 0.0, 'max_y' : 1.0 ,'Ra':1E6}
 simulator = RBC(params)
@@ -29,7 +35,9 @@ nc = int(init_t // range_t)
 nt = int(end_t // dt) + 2
 print(f'N0: {N0}, nt: {nt}, nx: {nx}, ny: {ny}, nlt: {nlt}, nc: {nc}')
 
-temp , velo , p = np.zeros((N0, nt, nx, ny)), np.zeros((N0, nt, nx, ny, 2)), np.zeros((N0, nt, nx, ny))
+data_path = 'data/nse_data_reg_rbc6_1'
+writer = TrajWriter(data_path + '_traj', {'obs': (N0, nt, nx, ny, 3), 'temp': (N0, nt, nx, ny, 1)}, resume=args.resume)
+obs, temp = writer['obs'], writer['temp']
 ctr = np.linspace(1, 3, N0).reshape(N0, 1).repeat(nc, 1) + (np.random.rand(N0, nc) * 2 - 1) * 2.0
 # ctr = np.linspace(0.1, 0.3, N0).reshape(N0, 1).repeat(nc, 1) + (np.random.rand(N0, nc) * 2 - 1) * 0.1
 # ctr = 2 * np.random.rand(N0, nc) + 1
@@ -45,6 +53,8 @@ print(ctr1, ctr2)
 
 for k in range(Nf):
     for l in range(Nf):
+        if writer.is_done(Nf * k + l):
+            continue
         print(f'start # {Nf * k + l + 1}')
         start = default_timer()
 
@@ -63,17 +73,21 @@ for k in range(Nf):
             simulator.step()
 
         for i in range(nt):
-            temp[Nf * k + l, i], velo[Nf * k + l, i], p[Nf * k + l, i], _  = simulator.step()
+            temp_t, velo_t, p_t, _  = simulator.step()
+            temp[Nf * k + l, i, ..., 0] = temp_t
+            obs[Nf * k + l, i, ..., :2] = velo_t
+            obs[Nf * k + l, i, ..., 2] = p_t
+        obs.flush()
+        temp.flush()
+        writer.commit(Nf * k + l)
     
         end = default_timer()
 
         print(f'end # {Nf * k + l + 1} | time: {end-start}')
 
-temp = torch.Tensor(temp).reshape(N0, nt, nx, ny, 1)
-velo = torch.Tensor(velo)
-p = torch.Tensor(p).reshape(N0, nt, nx, ny, 1)
+temp = writer.to_tensor('temp')
 # ctr = torch.Tensor(ctr).unsqueeze(-1).repeat(1, 1, nlt).reshape(N0, -1)
-obs = torch.cat((velo, p), dim=-1)
+obs = writer.to_tensor('obs')
 
 print(ctr.shape, obs.shape)
 
@@ -81,7 +95,7 @@ print(ctr.shape, obs.shape)
 # torch.save([obs, temp], 'data/nse_data_reg_rbc_test')
 
 # torch.save([obs, temp, ctr], 'data/nse_data_reg_rbc_orig5')
-torch.save([obs, temp], 'data/nse_data_reg_rbc6_1')
+torch.save([obs, temp], data_path)
 # torch.save([obs, temp], 'data/test_data/nse_data_reg_rbc7')
 
 # # evaluate
@@ -116,6 +130,7 @@ torch.save([obs, temp], 'data/nse_data_reg_rbc6_1')
 # obs, temp, ctr = data.get_data()
 # ctr = ctr[:, ::nlt]
 # ctr = ctr[0].unsqueeze(0)
+# data_path = 'data/nse_data_reg_rbc6_1'
 # temp , velo , p = np.zeros((N0, nt, nx, ny)), np.zeros((N0, nt, nx, ny, 2)), np.zeros((N0, nt, nx, ny))
 
 # for k in range(N0):
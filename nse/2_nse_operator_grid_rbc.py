@@ -11,6 +11,7 @@ def get_args(argv=None):
     parser.add_argument('-lf', '--logs_fname', default='test', type=str, help='logs file name')
     parser.add_argument('-dc', '--dict', default='rbc', type=str, help='dict name')
     parser.add_argument('-dr', '--data_rate', default=0.7, type=float, help='logs file name')
+    parser.add_argument('--lazy', action='store_true', help='memory-map the data and build samples on demand')
     
     parser.add_argument('-L', '--L', default=2, type=int, help='the number of layers')
     parser.add_argument('-m', '--modes', default=16, type=int, help='the number of modes of Fourier layer')
@@ -37,6 +38,7 @@ def get_args(argv=None):
     parser.add_argument('-l3', '--lambda3', default=0.05, type=float, help='weight of losses3')
     parser.add_argument('-l4', '--lambda4', default=0.5, type=float, help='weight of losses4')
     parser.add_argument('-fc', '--f_channels', default=1, type=int, help='channels of f encode')
+    parser.add_argument('--scheme', default='forward', type=str, help='derivative scheme of Lpde: forward, central, central4, spectral')
     
     return parser.parse_args(argv)
 
@@ -55,7 +57,7 @@ if __name__=='__main__':
     data_path = f'data/nse_data_reg_{args.data_path}'
     tg = args.tg     # sample evrey 5 timestamps
     Ng = args.Ng
-    data = LoadDataRBC(data_path)
+    data = LoadDataRBC(data_path, lazy=args.lazy)
     data.split()
     obs, temp, ctr = data.get_data()
     print('obs: ', obs.shape, 'obs.mean: ', obs.mean())
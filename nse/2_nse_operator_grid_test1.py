@@ -56,6 +56,7 @@ if __name__=='__main__':
     tg = args.tg     # sample evrey 5 timestamps
     Ng = args.Ng
     data = LoadDataNSE(data_path)
+    data.data_set = NSE_FieldDataset    # scripts_test models read broadcast ctr / Cd / Cl fields
     obs, Cd, Cl, ctr = data.split(Ng, tg)
     logs['data_norm'] = data.normalize('unif')   # unif: min, range  norm: mean, var
     logs['pred_model'] = []
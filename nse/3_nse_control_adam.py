@@ -7,151 +7,122 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from scripts.nets import *
-from env.Cylinder_Rotation_Env import Cylinder_Rotation_Env
+from scripts.models import *
+from scripts.utils import *
 
 import argparse
 
 
 def get_args(argv=None):
     parser = argparse.ArgumentParser(description='Put your hyperparameters')
-    
+
     parser.add_argument('-op', '--operator_path', default='ex17_dense_norm_sparse', type=str, help='path of operator weight')
-    parser.add_argument('-dn', '--data_num', default=0, type=int, help='data number')
+    parser.add_argument('-dp', '--data_path', default='data/nse_data_sparse', type=str, help='path of data')
+    parser.add_argument('-dn', '--data_num', default=None, type=int, nargs='+', help='data numbers, default all')
     parser.add_argument('-ts', '--t_start', default=10, type=int, help='control start time')
-    
+    parser.add_argument('--Cd_tg', default=0, type=float, help='target of Cd')
+    parser.add_argument('--Cl_tg', default=0, type=float, help='target of Cl')
+    parser.add_argument('--w_Cl', default=0.1, type=float, help='weight of Cl loss')
+
     parser.add_argument('--epochs', default=500, type=int, help='number of Epochs')
     parser.add_argument('--lr', default=5e-1, type=float, help='learning rate')
     parser.add_argument('--step_size', default=100, type=int, help='scheduler step size')
     parser.add_argument('--gamma', default=0.5, type=float, help='scheduler factor')
-    parser.add_argument('--gpu', default=0, type=int, help='device number')
+    parser.add_argument('--seg_len', default=None, type=int, help='steps per checkpointed segment, default no checkpointing')
 
     return parser.parse_args(argv)
 
 
+def control_optim(model, state, ctr, data_norm, Cd_tg=0, Cl_tg=0, w_Cl=0.1,
+                  epochs=500, lr=5e-1, step_size=100, gamma=0.5, seg_len=None, log_freq=10):
+    """
+    Optimize the control sequences of N trajectories at once with Adam, the weights of model are kept frozen.
+    The loss is summed over the trajectories so every control sequence gets the gradient of its own loss.
+    <ARGS>
+    model : NSEModel with loaded weights
+    state : torch.Tensor shape of (N, nx, ny, 3), state at control start
+    ctr : torch.Tensor shape of (N, nt), initial guess of the control
+    data_norm : logs['data_norm'] of the operator, Cd / Cl are unnormalized before the loss
+    Cd_tg, Cl_tg : float or torch.Tensor shape of (N, 1), target of Cd / Cl
+    seg_len : segment length of the checkpointed rollout, bounds the memory of backward on long horizons
+    <RETURN>
+    ctr_optim : torch.Tensor shape of (N, nt)
+    logs : dict of loss (N) / Cd_nn / Cl_nn (N, nt) / obs_nn (N, nt, nx, ny, 3)
+    """
+    device = state.device
+    Cd_min, Cd_range = [v.to(device) for v in data_norm['Cd']]
+    Cl_min, Cl_range = [v.to(device) for v in data_norm['Cl']]
+
+    for param in list(model.pred_model.parameters()):
+        param.requires_grad = False
+
+    ctr_optim = ctr.clone().to(device).requires_grad_(True)
+    optimizer = torch.optim.Adam([ctr_optim], lr=lr)
+    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=step_size, gamma=gamma)
+
+    logs = dict()
+    logs['loss'], logs['Cd_nn'], logs['Cl_nn'] = [], [], []
+    for epoch in range(1, epochs + 1):
+        optimizer.zero_grad()
+
+        _, Cd_nn, Cl_nn = model.rollout(state, ctr_optim, seg_len)
+        Cd_nn = Cd_nn * Cd_range + Cd_min
+        Cl_nn = Cl_nn * Cl_range + Cl_min
+        loss = torch.mean((Cd_nn - Cd_tg) ** 2, 1) + w_Cl * torch.mean((Cl_nn - Cl_tg) ** 2, 1)
+        loss.sum().backward()
+        optimizer.step()
+        scheduler.step()
+
+        logs['loss'].append(loss.detach().cpu())
+        if epoch % log_freq == 0:
+            logs['Cd_nn'].append(Cd_nn.detach().cpu())
+            logs['Cl_nn'].append(Cl_nn.detach().cpu())
+            print("epoch: {:4}  loss: {:1.6f}  Cd_nn: {:1.6f}  Cl_nn: {:1.6f}  ang_optim: {:1.6f}"
+                  .format(epoch, loss.mean(), Cd_nn.mean(), Cl_nn.mean(), ctr_optim.mean()))
+
+    # states of the final control only, the epochs above need Cd / Cl alone
+    with torch.no_grad():
+        obs_nn, _, _ = model.rollout(state, ctr_optim, return_states=True)
+    logs['obs_nn'] = obs_nn.cpu()
+    return ctr_optim.detach(), logs
+
+
 if __name__ == '__main__':
     # argparser
     args = get_args()
 
     # path & load
-    data_path = 'data/nse_data_sparse'
-    operator_path = 'logs/phase1_' + args.operator_path
-
-    data_orig, Cd, Cl, ctr = torch.load(data_path, map_location=lambda storage, loc: storage)
-    data = torch.load(data_path)
-    state_dict, logs_model = torch.load(operator_path)
-
-    # log text
-    logs = dict()
-    logs['operator_path'] = operator_path
-    logs['obs_nn'] = []
-    logs['Cd_nn'] = []
-    logs['Cl_nn'] = []
-    logs['loss'] = []
-
-    # param setting
-    device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() else 'cpu')
-    epochs = args.epochs
-    lr = args.lr
-    step_size = args.step_size
-    gamma = args.gamma
-
-    L = logs_model['args'].L
-    modes = logs_model['args'].modes
-    width = logs_model['args'].width
-    model_params = dict()
-    model_params['modes'] = modes
-    model_params['width'] = width
-    model_params['L'] = L
-    f_channels = logs_model['args'].f_channels
-    
-    # data setting
-    data_num = args.data_num
-    t_start = args.t_start
-    logs['data_num'] = data_num
-    logs['t_start'] = t_start
-    
-    Cd_mean, Cd_var = logs_model['data_norm']['Cd']
-    Cl_mean, Cl_var = logs_model['data_norm']['Cl']
-    ctr_mean, ctr_var = logs_model['data_norm']['ctr']
-    obs_mean, obs_var = logs_model['data_norm']['obs']
-    tg = logs_model['args'].tg     # sample evrey 10 timestamps
+    operator_path = 'logs/model_nse/phase1_' + args.operator_path
+    state_dict_pred, state_dict_phys, logs_model = torch.load(operator_path)
+    tg = logs_model['args'].tg     # sample evrey 5 timestamps
     Ng = logs_model['args'].Ng
-    
-    print('load data finished')
-    data = data_orig[::Ng, ::tg, :, :, 2:]  
-    Cd = Cd[::Ng, ::tg]
-    Cl = Cl[::Ng, ::tg]
-    ctr = ctr[::Ng, ::tg]
-
-    print(f'ctr: {ctr[data_num]}')
-    data_in = data[data_num].squeeze()[t_start].to(device)
-
-    # data params
-    nx = data.shape[2] 
-    ny = data.shape[3]
-    shape = [nx, ny]
-    N0 = data.shape[0]                    # num of data sets
-    nt = data.shape[1] - 1                # nt
-    Ndata = N0 * nt
+
+    data = LoadDataNSE(args.data_path)
+    data.split(Ng, tg)
+    data.normalize('logs_unif', logs_model)
+    obs, Cd, Cl, ctr = data.get_data()
+    N0, nt, nx, ny = data.get_params()
     print('N0: {}, nt: {}, nx: {}, ny: {}'.format(N0, nt, nx, ny))
+    print('load data finished')
 
     # load_model
-    load_model = FNO_ensemble(model_params, shape, f_channels=f_channels).to(device)
-    load_model.load_state_dict(state_dict)
-    load_model.eval()
+    model = NSEModel_FNO([nx, ny], 0.01 * tg, logs_model['args'])
+    model.load_state(state_dict_pred, state_dict_phys)
+    device = model.device
 
-    for param in list(load_model.parameters()):
-        param.requires_grad = False
+    # data setting: all selected trajectories are optimized in one batch
+    data_num = list(range(N0)) if args.data_num is None else args.data_num
+    t_start = args.t_start
+    state = obs[data_num, t_start].to(device)
+    ctr_init = ctr[data_num, t_start:].to(device)
 
-    # training
-    obs_nn = torch.zeros(nt, nx, ny, 3)
-    obs_nn[:t_start] = data[data_num, 1:t_start+1]
-    ctr_optim = ctr[data_num].to(device)
-    print(ctr_optim.shape)
-    ctr_optim.requires_grad = True
-    
-    optimizer = torch.optim.Adam([ctr_optim], lr=lr)
-    scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=step_size, gamma=gamma)
-    
-    for epoch in range(1, epochs + 1):
-        optimizer.zero_grad()
+    ctr_optim, logs = control_optim(model, state, ctr_init, logs_model['data_norm'], args.Cd_tg, args.Cl_tg, args.w_Cl,
+                                    args.epochs, args.lr, args.step_size, args.gamma, args.seg_len)
 
-        out_nn = data_in.reshape(1, nx, ny, 3).to(device)
-        f_rec = torch.zeros(nt).to(device)
-        Cd_nn = torch.zeros(nt).to(device)
-        Cl_nn = torch.zeros(nt).to(device)
-        
-        loss = 0
-        for i in range(t_start, nt):
-            ang_nn = ctr_optim[i].reshape(1)
-            # ang_nn = ang_vel[data_num][i].reshape(1)
-            # print(ang_nn.shape)
-            pred, _, f_rec[i], _ = load_model(out_nn, ang_nn)
-            out_nn = pred[:, :, :, :3]
-            obs_nn[i] = out_nn
-            Cd_nn[i] = torch.mean(pred[:, :, :, -2]) 
-            Cl_nn[i] = torch.mean(pred[:, :, :, -1]) 
-            print(Cd_nn[i].item(), Cl_nn[i].item())
-        
-        Cd_nn = Cd_nn * Cd_var.to(device) + Cd_mean.to(device)
-        Cl_nn = Cl_nn * Cl_var.to(device) + Cl_mean.to(device)
-        loss = torch.mean(Cd_nn[t_start:] ** 2) + 0.1 * torch.mean(Cl_nn[t_start:] ** 2)
-        # loss += 0.05 * torch.mean((ang_optim[t_start:] - f_rec[t_start:]) ** 2)
-        # loss += 0.5 * torch.mean(ang_optim.squeeze() ** 2)
-        if(epoch%10 == 0):
-            print("epoch: {:4}  loss: {:1.6f}  Cd_nn: {:1.6f}  Cl_nn: {:1.6f}  ang_optim: {:1.6f}"
-                  .format(epoch, loss, Cd_nn[t_start:].mean(), Cl_nn[t_start:].mean(), ctr_optim[t_start:].mean()))
-        
-        loss.backward()
-        optimizer.step()
-        scheduler.step()
-        
-        logs['loss'].append(loss)
-        logs['obs_nn'].append(obs_nn)
-        logs['Cd_nn'].append(Cd_nn)
-        logs['Cl_nn'].append(Cl_nn)
-
-    print(ctr_optim)
-    logs['f_optim'] = ctr_optim
-    torch.save(logs, 'logs/phase2_logs_test')
\ No newline at end of file
+    # log text
+    logs['operator_path'] = operator_path
+    logs['data_num'] = data_num
+    logs['t_start'] = t_start
+    logs['f_optim'] = torch.cat((ctr[data_num, :t_start], ctr_optim.cpu()), dim=1)
+    print(logs['f_optim'])
+    torch.save(logs, 'logs/phase2_logs_test')
@@ -0,0 +1,133 @@
+import sys
+sys.path.append("..")
+sys.path.append("../env")
+
+from env.Cylinder_Rotation_Env import Cylinder_Rotation_Env
+import numpy as np
+import torch
+from timeit import default_timer
+
+from scripts.models import *
+from scripts.utils import *
+
+import argparse
+
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Put your hyperparameters')
+
+    parser.add_argument('-op', '--operator_path', default='ex17_dense_norm_sparse', type=str, help='path of operator weight')
+    parser.add_argument('-dt', '--dt', default=0.01, type=float, help='time step of the env')
+    parser.add_argument('-Ti', '--T_init', default=4, type=float, help='uncontrolled warm-up time')
+    parser.add_argument('-T', '--T', default=4, type=float, help='controlled time')
+    parser.add_argument('-H', '--horizon', default=10, type=int, help='planning horizon in operator steps')
+    parser.add_argument('--iters', default=5, type=int, help='Adam steps per control step')
+    parser.add_argument('--lr', default=1e-1, type=float, help='learning rate')
+    parser.add_argument('--Cd_tg', default=0, type=float, help='target of Cd')
+    parser.add_argument('--Cl_tg', default=0, type=float, help='target of Cl')
+    parser.add_argument('--w_Cl', default=0.1, type=float, help='weight of Cl loss')
+
+    return parser.parse_args(argv)
+
+
+def mpc_plan(model, state, plan, data_norm, iters=5, lr=1e-1, Cd_tg=0, Cl_tg=0, w_Cl=0.1, bound=(-1, 1)):
+    """
+    A few Adam steps on the control plan over a short horizon, warm-started from plan.
+    <ARGS>
+    model : NSEModel with loaded, frozen weights
+    state : torch.Tensor shape of (1, nx, ny, 3), current state
+    plan : torch.Tensor shape of (1, H), previous plan shifted by one step
+    <RETURN>
+    plan : torch.Tensor shape of (1, H)
+    loss : float, loss of the last Adam step
+    """
+    Cd_min, Cd_range = data_norm['Cd']
+    Cl_min, Cl_range = data_norm['Cl']
+    plan = plan.clone().requires_grad_(True)
+    optimizer = torch.optim.Adam([plan], lr=lr)
+    for _ in range(iters):
+        optimizer.zero_grad()
+        _, Cd_nn, Cl_nn = model.rollout(state, plan)
+        Cd_nn = Cd_nn * Cd_range + Cd_min
+        Cl_nn = Cl_nn * Cl_range + Cl_min
+        loss = torch.mean((Cd_nn - Cd_tg) ** 2) + w_Cl * torch.mean((Cl_nn - Cl_tg) ** 2)
+        loss.backward()
+        optimizer.step()
+        with torch.no_grad():
+            plan.clamp_(*bound)
+
+    return plan.detach(), loss.item()
+
+
+if __name__ == '__main__':
+    # argparser
+    args = get_args()
+    print(args)
+
+    # env init
+    env = Cylinder_Rotation_Env(params={'dt': args.dt, 'rho_0': 1, 'mu' : 1/1000,
+                                        'traj_max_T': 20, 'dimx': 256, 'dimy': 64,
+                                        'min_x' : 0,  'max_x' : 2.2,
+                                        'min_y' : 0,  'max_y' : 0.41,
+                                        'r' : 0.05,  'center':(0.2, 0.2),
+                                        'min_w': -1, 'max_w': 1,
+                                        'min_velocity': -1, 'max_velocity': 1,
+                                        'U_max': 1.5, })
+    dt = env.params['dt']
+    bound = (env.params['min_w'], env.params['max_w'])
+
+    # load_model
+    operator_path = 'logs/model_nse/phase1_' + args.operator_path
+    state_dict_pred, state_dict_phys, logs_model = torch.load(operator_path)
+    tg = logs_model['args'].tg     # one operator step holds the action for tg env steps
+    nx, ny = env.params['dimx'], env.params['dimy']
+    model = NSEModel_FNO([nx, ny], dt * tg, logs_model['args'])
+    model.load_state(state_dict_pred, state_dict_phys)
+    device = model.device
+    for param in list(model.pred_model.parameters()):
+        param.requires_grad = False
+    data_norm = {key: [v.to(device) for v in logs_model['data_norm'][key]] for key in ['Cd', 'Cl']}
+
+    # env warm-up
+    obs = env.reset()
+    for i in range(int(args.T_init / dt)):
+        obs, _, _ = env.step(0.00)
+    print('init complete')
+
+    # mpc loop
+    nT = int(args.T / (dt * tg))
+    f = np.zeros(nT)
+    C_D, C_L = np.zeros(nT * tg), np.zeros(nT * tg)
+    t_plan, t_env, loss = np.zeros(nT), np.zeros(nT), np.zeros(nT)
+    plan = torch.zeros(1, args.horizon, device=device)
+    for k in range(nT):
+        # re-sync the surrogate state from the observation, warm start from the shifted plan
+        t1 = default_timer()
+        state = torch.tensor(obs[..., 2:], dtype=torch.float, device=device).unsqueeze(0)
+        plan = torch.cat((plan[:, 1:], plan[:, -1:]), dim=1)
+        plan, loss[k] = mpc_plan(model, state, plan, data_norm, args.iters, args.lr, args.Cd_tg, args.Cl_tg, args.w_Cl, bound)
+        f[k] = plan[0, 0].item()
+        t2 = default_timer()
+
+        for i in range(tg):
+            obs, C_D[k * tg + i], C_L[k * tg + i] = env.step(f[k])
+        t3 = default_timer()
+        t_plan[k], t_env[k] = t2 - t1, t3 - t2
+
+        print(f'# {k} | f: {f[k]:1.4f} | C_D: {C_D[(k+1) * tg - 1]:1.4f} | C_L: {C_L[(k+1) * tg - 1]:1.4f} | loss: {loss[k]:1.4f}\
+              | plan: {t_plan[k]:1.4f}s | env: {t_env[k]:1.4f}s')
+
+    # the controller keeps up when planning is faster than the control interval of the env
+    print(f'plan latency: mean {t_plan.mean():1.4f}s | max {t_plan.max():1.4f}s | env step: mean {t_env.mean() / tg:1.4f}s\
+          | control interval: {dt * tg:1.4f}s')
+
+    logs = dict()
+    logs['args'] = args
+    logs['operator_path'] = operator_path
+    logs['f'] = f
+    logs['C_D'] = C_D
+    logs['C_L'] = C_L
+    logs['loss'] = loss
+    logs['t_plan'] = t_plan
+    logs['t_env'] = t_env
+    torch.save(logs, 'logs/phase2_logs_mpc')
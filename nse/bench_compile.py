@@ -0,0 +1,71 @@
+import torch
+import argparse
+from timeit import default_timer
+
+from scripts.nets import *
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Put your hyperparameters')
+    parser.add_argument('-L', '--L', default=2, type=int, help='the number of layers')
+    parser.add_argument('-w', '--width', default=32, type=int, help='the number of width of FNO layer')
+    parser.add_argument('-m', '--modes', default=16, type=int, help='the number of modes of Fourier layer')
+    parser.add_argument('-fc', '--f_channels', default=1, type=int, help='channels of f encode')
+    parser.add_argument('-bs', '--batch_size', default=1, type=int, help='batch size')
+    parser.add_argument('-n', '--n_iter', default=20, type=int, help='timed iterations')
+    parser.add_argument('--no_compile', action='store_true', help='skip torch.compile')
+
+    return parser.parse_args(argv)
+
+def bench(model, inputs, n_iter):
+    with torch.no_grad():
+        # warm up (dft cache, compilation)
+        model(*inputs)
+        t1 = default_timer()
+        for _ in range(n_iter):
+            model(*inputs)
+        t2 = default_timer()
+    return (t2 - t1) / n_iter * 1000
+
+def report(name, eager, wrapper, inputs, args):
+    # eager step vs the traced wrapper and torch.compile, all on cpu
+    models = {'torchscript': export_model(wrapper, inputs)}
+    if not args.no_compile:
+        models['compile'] = compile_model(wrapper)
+    with torch.no_grad():
+        ref = eager(*inputs)
+    t_eager = bench(eager, inputs, args.n_iter)
+    print(f'{name} | eager: {t_eager:1.2f} ms')
+    for key, model in models.items():
+        with torch.no_grad():
+            err = (model(*inputs) - ref).abs().max().item()
+        t = bench(model, inputs, args.n_iter)
+        print(f'    {key}: {t:1.2f} ms | speedup {t_eager / t:1.2f} | max abs diff: {err:1.2e}')
+
+class Pred(nn.Module):
+    # eager reference: prediction path of the ensemble
+    def __init__(self, model):
+        super(Pred, self).__init__()
+        self.model = model
+
+    def forward(self, x, ctr):
+        return self.model(x, ctr, mode='pred')[0]
+
+if __name__ == '__main__':
+    args = get_args()
+    torch.set_grad_enabled(False)
+    print(f'threads: {torch.get_num_threads()}')
+
+    # shapes used by the project: nse 256 x 64, rbc 64 x 32
+    bs = args.batch_size
+    for name, net, (nx, ny), Lxy in [('FNO_ensemble', FNO_ensemble, (256, 64), [2.2, 0.41]),
+                                     ('FNO_ensemble_RBC', FNO_ensemble_RBC, (64, 32), [2.0, 2.0])]:
+        model_params = {'modes': args.modes, 'width': args.width, 'L': args.L, 'shape': [nx, ny],
+                        'f_channels': args.f_channels, 'Lxy': Lxy}
+        model = net(model_params).eval()
+        ctr = torch.rand(bs) if net is FNO_ensemble else torch.rand(bs, nx, ny, 1)
+        report(f'{name} {nx} x {ny}', Pred(model), FNO_ensemble_infer(model, (nx, ny)), (torch.rand(bs, nx, ny, 3), ctr), args)
+
+        if net is FNO_ensemble:
+            phys = state_mo(model_params).eval()
+            report(f'state_mo {nx} x {ny}', phys, state_mo_infer(phys, (nx, ny)),
+                   (torch.rand(bs, nx, ny, 3), torch.rand(bs), torch.rand(bs, nx, ny, 3)), args)
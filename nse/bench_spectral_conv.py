@@ -0,0 +1,66 @@
+import torch
+import argparse
+from timeit import default_timer
+
+from scripts.nets import SpectralConv2d, SpectralConv2d_prev
+
+def get_args(argv=None):
+    parser = argparse.ArgumentParser(description='Put your hyperparameters')
+    parser.add_argument('-w', '--width', default=32, type=int, help='the number of width of FNO layer')
+    parser.add_argument('-m', '--modes', default=16, type=int, help='the number of modes of Fourier layer')
+    parser.add_argument('-bs', '--batch_size', default=32, type=int, help='batch size')
+    parser.add_argument('-n', '--n_iter', default=20, type=int, help='timed iterations')
+    parser.add_argument('--gpu', default=0, type=int, help='device number')
+
+    return parser.parse_args(argv)
+
+def bench(layer, x, n_iter, backward=False):
+    def run():
+        out = layer(x)
+        if backward:
+            out.sum().backward()
+    # warm up (dft cache, allocator)
+    run()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    t1 = default_timer()
+    for _ in range(n_iter):
+        run()
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    t2 = default_timer()
+    return (t2 - t1) / n_iter * 1000
+
+if __name__ == '__main__':
+    args = get_args()
+    device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() else 'cpu')
+    print(f'device: {device}')
+
+    # shapes used by the project: nse 256 x 64, rbc 64 x 32
+    for nx, ny in [(256, 64), (64, 32)]:
+        modes = min(args.modes, nx // 2, ny // 2 + 1)
+        layer_prev = SpectralConv2d_prev(args.width, args.width, modes, modes).to(device)
+        layer = SpectralConv2d(args.width, args.width, modes, modes).to(device)
+        layer.load_state_dict(layer_prev.state_dict())
+        layer_dft = SpectralConv2d(args.width, args.width, modes, modes).to(device)
+        layer_dft.load_state_dict(layer_prev.state_dict())
+        layer_dft.use_dft = True
+
+        x = torch.rand(args.batch_size, args.width, nx, ny, device=device)
+        print(f'{nx} x {ny} | modes: {modes}')
+        with torch.no_grad():
+            ref = layer_prev(x)
+            t_prev = bench(layer_prev, x, args.n_iter)
+        x.requires_grad_(True)
+        tb_prev = bench(layer_prev, x, args.n_iter, True)
+        x.requires_grad_(False)
+        print(f'    prev | forward: {t_prev:1.2f} ms | forward + backward: {tb_prev:1.2f} ms')
+        for name, l in [('fft', layer), ('dft', layer_dft)]:
+            with torch.no_grad():
+                err = (l(x) - ref).abs().max().item()
+                t = bench(l, x, args.n_iter)
+            x.requires_grad_(True)
+            tb = bench(l, x, args.n_iter, True)
+            x.requires_grad_(False)
+            print(f'    {name} | forward: {t:1.2f} ms (speedup {t_prev / t:1.2f}) | forward + backward: {tb:1.2f} ms '
+                  f'(speedup {tb_prev / tb:1.2f}) | max abs diff: {err:1.2e}')
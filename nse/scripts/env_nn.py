@@ -0,0 +1,105 @@
+import numpy as np
+import torch
+
+from scripts.nets import *
+from scripts.utils import *
+
+
+class Cylinder_Rotation_Env_NN:
+    """
+    Cylinder_Rotation_Env served by a trained FNO_ensemble, num_envs trajectories are stepped in one batch.
+    step / reset return the (obs, C_D, C_L) / obs of the FEniCS env in unnormalized units, one step of
+    the operator covers tg steps (dt = 0.01 * tg) of the data it was trained on.
+    check_env: optional real Cylinder_Rotation_Env started from the same state as env 0, every check_freq steps
+    it replays the actions of env 0 since the last check and the errors are appended to check_log.
+    """
+    def __init__(self, operator_path, num_envs=1, check_env=None, check_freq=0, resync=True, device='cpu'):
+        state_dict_pred, _, logs = torch.load(operator_path, map_location='cpu')
+        args = logs['args']
+        self.Cd_min, self.Cd_range = logs['data_norm']['Cd']
+        self.Cl_min, self.Cl_range = logs['data_norm']['Cl']
+        self.tg = args.tg
+        self.dt = 0.01 * args.tg
+        self.num_envs = num_envs
+        self.device = torch.device(device)
+
+        # the FNO does not fix the grid, it is taken from the check env or the data generation defaults
+        self.params = check_env.params if check_env is not None else {'dimx': 256, 'dimy': 64,
+                                                                      'min_x' : 0,  'max_x' : 2.2,
+                                                                      'min_y' : 0,  'max_y' : 0.41,
+                                                                      'min_w': -1, 'max_w': 1}
+        nx, ny = self.params['dimx'], self.params['dimy']
+        xs = np.linspace(self.params['min_x'], self.params['max_x'], nx)
+        ys = np.linspace(self.params['min_y'], self.params['max_y'], ny)
+        my, mx = np.meshgrid(ys, xs)
+        self.grids = np.stack((mx, my), 2)
+
+        model_params = dict()
+        model_params['modes'] = args.modes
+        model_params['width'] = args.width
+        model_params['L'] = args.L
+        model_params['shape'] = [nx, ny]
+        model_params['f_channels'] = args.f_channels
+        model_params['Lxy'] = [self.params['max_x'] - self.params['min_x'], self.params['max_y'] - self.params['min_y']]
+        self.model = FNO_ensemble(model_params).to(self.device)
+        self.model.load_state_dict(state_dict_pred)
+        self.model.eval()
+
+        self.check_env = check_env
+        self.check_freq = check_freq
+        self.resync = resync
+        self.check_log = []
+        self.init_state = None
+        self.current_t = 0
+
+    def to_obs(self, state):
+        # [num_envs, nx, ny, 3] -> [num_envs, nx, ny, 5] with the grid coordinates in front
+        state = state.cpu().numpy()
+        grids = np.broadcast_to(self.grids, (state.shape[0], *self.grids.shape))
+        return np.concatenate([grids, state], axis=-1)
+
+    def set_init(self, obs):
+        # obs: [nx, ny, 5] or [num_envs, nx, ny, 5], start state of reset
+        obs = torch.tensor(np.asarray(obs)[..., -3:], dtype=torch.float)
+        self.init_state = obs.reshape(-1, *obs.shape[-3:]).expand(self.num_envs, -1, -1, -1).clone()
+
+    def reset(self, obs=None):
+        if self.check_env is not None:
+            obs = self.check_env.reset()
+        if obs is not None:
+            self.set_init(obs)
+        self.state = self.init_state.to(self.device)
+        self.actions = []
+        self.current_t = 0
+        return self.to_obs(self.state)
+
+    def step(self, action):
+        # action: float or [num_envs] -> obs [num_envs, nx, ny, 5], C_D [num_envs], C_L [num_envs]
+        ctr = torch.tensor(action, dtype=torch.float, device=self.device).reshape(-1).expand(self.num_envs)
+        with torch.no_grad():
+            pred, _, _, _ = self.model(self.state, ctr, mode='pred')
+        self.state = pred[..., :3]
+        C_D = torch.mean(pred[..., -2].reshape(self.num_envs, -1), 1).cpu() * self.Cd_range + self.Cd_min
+        C_L = torch.mean(pred[..., -1].reshape(self.num_envs, -1), 1).cpu() * self.Cl_range + self.Cl_min
+        self.current_t += 1
+
+        if self.check_env is not None and self.check_freq > 0:
+            self.actions.append(ctr[0].item())
+            if self.current_t % self.check_freq == 0:
+                self.cross_check(C_D[0].item(), C_L[0].item())
+
+        return self.to_obs(self.state), C_D.numpy(), C_L.numpy()
+
+    def cross_check(self, C_D_nn, C_L_nn):
+        # replay the buffered actions of env 0 on the solver, each held for tg solver steps
+        for f in self.actions:
+            for i in range(self.tg):
+                obs, C_D, C_L = self.check_env.step(f)
+        self.actions = []
+        state = torch.tensor(obs[..., -3:], dtype=torch.float, device=self.device)
+        error = rel_error(self.state[:1], state.unsqueeze(0)).item()
+        self.check_log.append({'t': self.current_t, 'error_state': error,
+                               'error_Cd': C_D_nn - C_D, 'error_Cl': C_L_nn - C_L})
+        print(f'check # {self.current_t} | error_state: {error:1.4f} | error_Cd: {C_D_nn - C_D:1.4f} | error_Cl: {C_L_nn - C_L:1.4f}')
+        if self.resync:
+            self.state[0] = state
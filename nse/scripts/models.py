@@ -1,5 +1,6 @@
 from email.policy import default
 import torch
+from torch.utils.checkpoint import checkpoint
 from torch.utils.data import DataLoader
 from timeit import default_timer
 import copy
@@ -14,6 +15,8 @@ class NSEModel():
         self.nx, self.ny = self.shape
         self.dt = dt
         self.params = args
+        # derivative scheme of the pde residual: forward / central / central4 / spectral
+        self.scheme = getattr(args, 'scheme', 'forward')
         self.device = torch.device('cuda:{}'.format(self.params.gpu) if torch.cuda.is_available() else 'cpu')
 
     def set_model(self, pred_model=FNO_ensemble, phys_model=state_mo):
@@ -66,21 +69,20 @@ class NSEModel():
         t1 = default_timer()
         train_log = PredLog(length=self.params.batch_size)
         
-        for x_train, y_train in train_loader:
-            x_train, y_train = x_train.to(self.device), y_train.to(self.device)
+        for batch in train_loader:
+            # split data read in train_loader
+            in_train, ctr_train, out_train, coef_train = self.split_batch(batch)
             
             self.pred_optimizer.zero_grad()
             self.phys_optimizer.zero_grad()
-            
-            # split data read in train_loader
-            in_train, ctr_train = x_train[:, :, :, :-1], x_train[:, :, :, -1].unsqueeze(-1)
-            out_train = y_train[:, :, :, :3]
-            opt_train = y_train
+
+            # derivatives of in_train are shared by every Lpde / phys_model call below
+            derivs = self.state_derivs(in_train)
 
             # put data to generate 4 loss
-            loss1, loss2, loss3, loss4, loss6 = self.pred_loss(in_train, ctr_train, opt_train)
-            mod = self.phys_model(in_train, ctr_train, out_train)
-            loss5 = ((Lpde(in_train, out_train, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod) ** 2).mean()
+            loss1, loss2, loss3, loss4, loss6 = self.pred_loss(in_train, ctr_train, out_train, coef_train, derivs)
+            mod = self.phys_model(in_train, ctr_train, out_train, derivs)
+            loss5 = ((Lpde(in_train, out_train, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod) ** 2).mean()
 
             self.train_step(loss1, loss2, loss3, loss4, loss5, loss6)
 
@@ -96,11 +98,11 @@ class NSEModel():
         loss_pde = AverageMeter()
         t3 = default_timer()
 
-        for x_train, _ in train_loader:
-            x_train = x_train.to(self.device)
-
+        for batch in train_loader:
             # split data read in train_loader
-            in_new, ctr_new = x_train[:, :, :, :-1], x_train[:, :, :, -1].unsqueeze(-1)
+            in_new, ctr_new, _, _ = self.split_batch(batch)
+            # the augmentation perturbs (and scales against) the per-pixel control field as before the scalar batches
+            ctr_new = expand_ctr(ctr_new, in_new.shape).contiguous()
 
             self.phys_model.eval()
 
@@ -110,11 +112,12 @@ class NSEModel():
             self.pred_model.train()
             self.pred_optimizer.zero_grad()
 
-            pred, _, _, _ = self.pred_model(in_train, ctr_train)
+            pred, _, _, _ = self.pred_model(in_train, ctr_train, 'pred')
             out_pred = pred[:, :, :, :3]
-            mod = self.phys_model(in_train, ctr_train, out_pred)
+            derivs = self.state_derivs(in_train)
+            mod = self.phys_model(in_train, ctr_train, out_pred, derivs)
             # 多训练几次？  
-            loss = ((Lpde(in_train, out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod) ** 2).mean()
+            loss = ((Lpde(in_train, out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod) ** 2).mean()
             loss.backward()
             self.pred_optimizer.step()
             loss_pde.update(loss.item(), self.params.batch_size)
@@ -124,6 +127,7 @@ class NSEModel():
         print('----phys training: # {} {:1.2f} (pde) pred: {:1.2e} | '.format(phys_epoch, t4-t3, loss_pde.avg))
     
     def gen_new_data(self, in_new, ctr_new, random=False):
+        # ctr_new: field [B, nx, ny, 1] (per-pixel perturbation) or per-sample [B, 1] (one shift per sample), as given
         if random == True:
             in_train = in_new + torch.rand(in_new.shape).cuda() * self.params.phys_scale
             ctr_train = ctr_new + torch.rand(ctr_new.shape).cuda() * self.params.phys_scale
@@ -139,10 +143,11 @@ class NSEModel():
                 ctr_new = ctr_new.requires_grad_(True)
                 # ctr_new = ctr_new.reshape(ctr_new.shape[0], 1, 1, 1).repeat(1, self.nx, self.ny, 1)
                 in_new = in_new.requires_grad_(True)
-                pred, _, _, _ = self.pred_model(in_new, ctr_new)
+                pred, _, _, _ = self.pred_model(in_new, ctr_new, 'pred')
                 out_pred = pred[:, :, :, :3]
-                mod = self.phys_model(in_new, ctr_new, out_pred)
-                loss = ((Lpde(in_new, out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod) ** 2).mean()
+                derivs = self.state_derivs(in_new)
+                mod = self.phys_model(in_new, ctr_new, out_pred, derivs)
+                loss = ((Lpde(in_new, out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod) ** 2).mean()
                 loss.backward()
                 # print(ctr_new.is_leaf, in_new.is_leaf)
                 dLf = ctr_new.grad
@@ -164,45 +169,125 @@ class NSEModel():
         self.phys_model.eval()
         test_log = PredLog(length=self.params.batch_size)
         with torch.no_grad():
-            for x_test, y_test in test_loader:
-                x_test, y_test = x_test.to(self.device), y_test.to(self.device)
+            for batch in test_loader:
                 # split data read in test_loader
-                in_test, ctr_test = x_test[:, :, :, :-1], x_test[:, :, :, -1].unsqueeze(-1)
-                out_test = y_test[:, :, :, :3]
-                opt_test = y_test
+                in_test, ctr_test, out_test, coef_test = self.split_batch(batch)
 
-                loss1, loss2, loss3, loss4, loss6 = self.pred_loss(in_test, ctr_test, opt_test)
-                mod = self.phys_model(in_test, ctr_test, out_test)
-                loss5 = ((Lpde(in_test, out_test, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod) ** 2).mean()
+                derivs = self.state_derivs(in_test)
+                loss1, loss2, loss3, loss4, loss6 = self.pred_loss(in_test, ctr_test, out_test, coef_test, derivs)
+                mod = self.phys_model(in_test, ctr_test, out_test, derivs)
+                loss5 = ((Lpde(in_test, out_test, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod) ** 2).mean()
                 test_log.update([loss1.item(), loss2.item(), loss3.item(), loss4.item(), loss5.item(), loss6.item()])
             test_log.save_log(logs)
         
         print('--test | (pred): {:1.2e}  (rec) state: {:1.2e}  ctr: {:1.2e} (latent): {:1.2e} (pde) obs: {:1.2e} pred: {:1.2e}'
               .format(test_log.loss1.avg, test_log.loss2.avg, test_log.loss3.avg, test_log.loss4.avg, test_log.loss5.avg, test_log.loss6.avg))
 
-    def pred_loss(self, ipt, ctr, opt):
-        out, Cd, Cl = opt[:, :, :, :3], opt[:, 0, 0, -2], opt[:, 0, 0, -1]
+    def state_derivs(self, state):
+        # one derivative bundle per state tensor, passed to both Lpde and phys_model
+        return StateDerivs(state, self.Lx, self.Ly, self.scheme)
+
+    def split_batch(self, batch):
+        # (ipt, ctr, out, coef): ctr [B, 1] and coef = (Cd, Cl) [B, 2] stay scalars until the nets broadcast them
+        ipt, ctr, out, coef = [item.to(self.device) for item in batch]
+        return ipt, ctr, out, coef
+
+    def pred_loss(self, ipt, ctr, out, coef, derivs=None):
+        Cd, Cl = coef[:, 0], coef[:, 1]
+        if derivs is None:
+            derivs = self.state_derivs(ipt)
         # latent items
         out_latent = self.pred_model.stat_en(out)
         # prediction & rec items
-        out_pred, Cd_pred, Cl_pred, mod_pred, ipt_rec, ctr_rec, trans_out = self.model_step(ipt, ctr)
+        out_pred, Cd_pred, Cl_pred, mod_pred, ipt_rec, ctr_rec, trans_out = self.model_step(ipt, ctr, derivs)
         
         loss1 = rel_error(out_pred, out).mean() + rel_error(Cd_pred, Cd).mean() + rel_error(Cl_pred, Cl).mean()
         loss2 = rel_error(ipt_rec, ipt).mean()
-        loss3 = rel_error(ctr_rec, ctr).mean()
+        loss3 = rel_error(ctr_rec, expand_ctr(ctr, ipt.shape)).mean()
         loss4 = rel_error(trans_out, out_latent).mean()
-        loss6 = ((Lpde(ipt, out_pred, self.dt, Re = self.Re) + mod_pred) ** 2).mean()
+        loss6 = ((Lpde(ipt, out_pred, self.dt, Re = self.Re, derivs = derivs) + mod_pred) ** 2).mean()
 
         return loss1, loss2, loss3, loss4, loss6
 
-    def model_step(self, ipt, ctr):
-        pred, x_rec, ctr_rec, trans_out = self.pred_model(ipt, ctr)
-        ipt_rec = x_rec[:, :, :, :3]
+    def model_step(self, ipt, ctr, derivs=None, mode='train'):
+        # mode 'pred' skips the reconstruction decoders, ipt_rec / ctr_rec are then None
+        pred, x_rec, ctr_rec, trans_out = self.pred_model(ipt, ctr, mode)
+        ipt_rec = x_rec[:, :, :, :3] if x_rec is not None else None
+        out_pred, Cd_pred, Cl_pred = self.split_pred(pred)
+        mod_pred = self.phys_model(ipt, ctr, out_pred, derivs)
+        return out_pred, Cd_pred, Cl_pred, mod_pred, ipt_rec, ctr_rec, trans_out
+
+    def split_pred(self, pred):
+        # decoder output [N0, nx, ny, 5] -> state, Cd, Cl
         out_pred = pred[:, :, :, :3]
         Cd_pred = torch.mean(pred[:, :, :, -2].reshape(pred.shape[0], -1), 1)
         Cl_pred = torch.mean(pred[:, :, :, -1].reshape(pred.shape[0], -1), 1)
-        mod_pred = self.phys_model(ipt, ctr, out_pred)
-        return out_pred, Cd_pred, Cl_pred, mod_pred, ipt_rec, ctr_rec, trans_out
+        return out_pred, Cd_pred, Cl_pred
+
+    def latent_rollout(self, state, ctr, out_steps=None):
+        """
+        Autoregressive rollout kept in the latent space: the state is encoded once, trans_net is applied
+        for every control and only the requested steps are decoded.
+        <ARGS>
+        state : torch.Tensor shape of (N0, nx, ny, 3), initial state
+        ctr : torch.Tensor shape of (N0, nt) or (N0, nt, nx, ny, 1)
+        out_steps : steps k whose prediction (state k+1) is decoded, default all
+        <RETURN>
+        pred : torch.Tensor shape of (N0, len(out_steps), nx, ny, C), decoder output
+        """
+        out_steps = sorted(set(range(ctr.shape[1]) if out_steps is None else out_steps))
+        decode = set(out_steps)
+        x_latent = self.pred_model.stat_en(state)
+        pred = []
+        for k in range(out_steps[-1] + 1):
+            x_latent = self.pred_model.latent_step(x_latent, ctr[:, k])
+            if k in decode:
+                pred.append(self.pred_model.stat_de(x_latent))
+
+        return torch.stack(pred, dim=1)
+
+    def rollout(self, state, ctr, seg_len=None, return_states=False):
+        """
+        Differentiable autoregressive rollout of pred_model under the control sequences ctr.
+        <ARGS>
+        state : torch.Tensor shape of (N0, nx, ny, 3), initial state
+        ctr : torch.Tensor shape of (N0, nt) or (N0, nt, nx, ny, 1)
+        seg_len : gradient checkpointing, only the states at segment boundaries are kept in forward and
+                  the activations of each seg_len-step segment are recomputed in backward, default off
+        return_states : collect the predicted states, off for Cd / Cl only rollouts (e.g. the control loss)
+        <RETURN>
+        out_nn : torch.Tensor shape of (N0, nt, nx, ny, 3), detached predicted states, None without return_states
+        Cd_nn, Cl_nn : torch.Tensor shape of (N0, nt)
+        """
+        nt = ctr.shape[1]
+        seg_len = nt if seg_len is None else seg_len
+        use_ckpt = seg_len < nt and torch.is_grad_enabled()
+        out_nn, Cd_nn, Cl_nn = [], [], []
+        for k in range(0, nt, seg_len):
+            if use_ckpt:
+                state, out_seg, Cd_seg, Cl_seg = checkpoint(self.rollout_seg, state, ctr[:, k:k+seg_len], return_states,
+                                                            use_reentrant=False)
+            else:
+                state, out_seg, Cd_seg, Cl_seg = self.rollout_seg(state, ctr[:, k:k+seg_len], return_states)
+            out_nn.append(out_seg)
+            Cd_nn.append(Cd_seg)
+            Cl_nn.append(Cl_seg)
+
+        out_nn = torch.cat(out_nn, dim=1) if return_states else None
+        return out_nn, torch.cat(Cd_nn, dim=1), torch.cat(Cl_nn, dim=1)
+
+    def rollout_seg(self, state, ctr, return_states=False):
+        out_seg, Cd_seg, Cl_seg = [], [], []
+        for k in range(ctr.shape[1]):
+            pred, _, _, _ = self.pred_model(state, ctr[:, k], mode='pred')
+            state, Cd, Cl = self.split_pred(pred)
+            if return_states:
+                out_seg.append(state.detach())
+            Cd_seg.append(Cd)
+            Cl_seg.append(Cl)
+
+        out_seg = torch.stack(out_seg, dim=1) if return_states else None
+        return state, out_seg, torch.stack(Cd_seg, dim=1), torch.stack(Cl_seg, dim=1)
 
     def train_step(self, loss1, loss2, loss3, loss4, loss5, loss6):
         lambda1, lambda2, lambda3, lambda4 = self.params.lambda1, self.params.lambda2, self.params.lambda3, self.params.lambda4
@@ -228,58 +313,102 @@ class NSEModel_FNO(NSEModel):
         self.Ly = 0.41
         self.set_model()
     
-    def cal_1step(self, data):
+    def cal_1step(self, data, batch_size=16, keep_fields=False):
+        """
+        One-step prediction errors and pde residuals, streamed over chunks of batch_size trajectories (None: all at once).
+        <RETURN>
+        error_1step : torch.Tensor shape of (N0, nt)
+        Lpde_obs, Lpde_pred : torch.Tensor shape of (N0, nt, nx, ny, 2), or the (N0, nt) spatial means
+                              when keep_fields is False
+        """
         obs, Cd, Cl, ctr = data.get_data()
         N0, nt = obs.shape[0], obs.shape[1] - 1
         nx, ny = self.shape
-        out_nn, Lpde_obs, Lpde_pred = torch.zeros(N0, nt, nx, ny, 3), torch.zeros(N0, nt, nx, ny, 2), torch.zeros(N0, nt, nx, ny, 2)
-        Cd_nn, Cl_nn = torch.zeros(N0, nt), torch.zeros(N0, nt)
+        batch_size = N0 if batch_size is None else batch_size
+        device = next(self.pred_model.parameters()).device
+        Lpde_shape = (N0, nt, nx, ny, 2) if keep_fields else (N0, nt)
+        Lpde_obs, Lpde_pred = torch.zeros(Lpde_shape), torch.zeros(Lpde_shape)
         error_1step, error_Cd, error_Cl = torch.zeros(N0, nt), torch.zeros(N0, nt), torch.zeros(N0, nt)
         with torch.no_grad():
-            for k in range(nt):
-                t1 = default_timer()
-                out_nn[:, k], Cd_nn[:, k], Cl_nn[:, k], mod_pred, _, _, _ = self.model_step(obs[:, k], ctr[:, k])
-                Lpde_pred[:, k] = ((Lpde(obs[:, k], out_nn[:, k], self.dt, Lx = self.Lx, Ly = self.Ly) + mod_pred) ** 2)
-
-                mod_obs = self.phys_model(obs[:, k], ctr[:, k], obs[:, k+1])
-                Lpde_obs[:, k] = ((Lpde(obs[:, k], obs[:, k+1], self.dt, Lx = self.Lx, Ly = self.Ly) + mod_obs) ** 2)
-                
-                error_1step[:, k] = rel_error(out_nn[:, k], obs[:, k+1]) 
-                error_Cd[:, k] = ((Cd_nn[:, k] - Cd[:, k]) ** 2)
-                error_Cl[:, k] = ((Cl_nn[:, k] - Cl[:, k]) ** 2)
-                t2 = default_timer()
-                if k % 10 == 0:
-                    print(f'# {k} | {t2 - t1:1.2f}: error_Cd: {error_Cd[:, k].mean():1.4f} | error_Cl: {error_Cl[:, k].mean():1.4f} | error_state: {error_1step[:, k].max():1.4f}\
-                        | pred_Lpde: {Lpde_pred[:, k].mean():1.4f} | obs_Lpde: {Lpde_obs[:, k].mean():1.4f}')
+            for i in range(0, N0, batch_size):
+                n = slice(i, min(i + batch_size, N0))
+                obs_b, Cd_b, Cl_b, ctr_b = obs[n].to(device), Cd[n].to(device), Cl[n].to(device), ctr[n].to(device)
+                for k in range(nt):
+                    t1 = default_timer()
+                    derivs = self.state_derivs(obs_b[:, k])
+                    pred, _, _, _ = self.pred_model(obs_b[:, k], ctr_b[:, k], mode='pred')
+                    out_pred, Cd_pred, Cl_pred = self.split_pred(pred)
+
+                    # prediction & observation residuals in one pass of phys_model / Lpde
+                    ipt = torch.cat((obs_b[:, k], obs_b[:, k]))
+                    out = torch.cat((out_pred, obs_b[:, k+1]))
+                    derivs = derivs.repeat(2)
+                    mod = self.phys_model(ipt, torch.cat((ctr_b[:, k], ctr_b[:, k])), out, derivs)
+                    res = ((Lpde(ipt, out, self.dt, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod) ** 2).cpu()
+                    if not keep_fields:
+                        res = res.reshape(res.shape[0], -1).mean(1)
+                    Lpde_pred[n, k], Lpde_obs[n, k] = res.chunk(2)
+
+                    error_1step[n, k] = rel_error(out_pred, obs_b[:, k+1]).cpu()
+                    error_Cd[n, k] = ((Cd_pred - Cd_b[:, k]) ** 2).cpu()
+                    error_Cl[n, k] = ((Cl_pred - Cl_b[:, k]) ** 2).cpu()
+                    t2 = default_timer()
+                    if k % 10 == 0:
+                        print(f'# {i} | {k} | {t2 - t1:1.2f}: error_Cd: {error_Cd[n, k].mean():1.4f} | error_Cl: {error_Cl[n, k].mean():1.4f} | error_state: {error_1step[n, k].max():1.4f}\
+                            | pred_Lpde: {Lpde_pred[n, k].mean():1.4f} | obs_Lpde: {Lpde_obs[n, k].mean():1.4f}')
 
         return error_1step, Lpde_obs, Lpde_pred
 
-    def process(self, data):
+    def process(self, data, latent=False, batch_size=16, keep_fields=False):
+        """
+        Rollouts from the first state of every trajectory, streamed over chunks of batch_size trajectories (None: all at once).
+        latent: propagate the latent state instead of re-encoding the decoded state every step
+        <RETURN>
+        out_nn : torch.Tensor shape of (N0, nt, nx, ny, 3), None when keep_fields is False
+        Lpde_pred : torch.Tensor shape of (N0, nt, nx, ny, 2), or the (N0, nt) spatial means when keep_fields is False
+        error_cul : torch.Tensor shape of (N0, nt)
+        """
         obs, Cd, Cl, ctr = data.get_data()
-        init_k = 0
-        self.set_init(obs[:, init_k])
         N0, nt = obs.shape[0], obs.shape[1] - 1
         nx, ny = self.shape
         print(f'N0: {N0}, nt: {nt}, nx: {nx}, ny: {ny}')
-        out_nn, Lpde_pred = torch.zeros(N0, nt, nx, ny, 3), torch.zeros(N0, nt, nx, ny, 2)
-        Cd_nn, Cl_nn = torch.zeros(N0, nt), torch.zeros(N0, nt)
+        batch_size = N0 if batch_size is None else batch_size
+        device = next(self.pred_model.parameters()).device
+        out_nn = torch.zeros(N0, nt, nx, ny, 3) if keep_fields else None
+        Lpde_pred = torch.zeros((N0, nt, nx, ny, 2) if keep_fields else (N0, nt))
         error_cul, error_Cd, error_Cl = torch.zeros(N0, nt), torch.zeros(N0, nt), torch.zeros(N0, nt)
         with torch.no_grad():
-            for k in range(init_k, nt):
-                t1 = default_timer()
-                out_nn[:, k], Cd_nn[:, k], Cl_nn[:, k], mod_pred, _, _, _ = self.model_step(self.in_nn, ctr[:, k])
-                # print(pred.shape, mod_pred.shape, self.in_nn.shape)
-                Lpde_pred[:, k] = ((Lpde(self.in_nn, out_nn[:, k], self.dt, self.Re) + mod_pred) ** 2)
-                self.in_nn = out_nn[:, k]
-                error_cul[:, k] = rel_error(out_nn[:, k], obs[:, k+1]) 
-                error_Cd[:, k] = ((Cd_nn[:, k] - Cd[:, k]) ** 2)
-                error_Cl[:, k] = ((Cl_nn[:, k] - Cl[:, k]) ** 2)
-                t2 = default_timer()
-                if k % 10 == 0:
-                    print(f'# {k} | {t2 - t1:1.2f}: error_Cd: {error_Cd[:, k].mean():1.4f} | error_Cl: {error_Cl[:, k].mean():1.4f} | \
-                            error_state: {error_cul[:, k].mean():1.4f}| cul_Lpde: {Lpde_pred[:, k].mean():1.4f}')
-
-        return out_nn, Lpde_pred
+            for i in range(0, N0, batch_size):
+                n = slice(i, min(i + batch_size, N0))
+                obs_b, Cd_b, Cl_b, ctr_b = obs[n].to(device), Cd[n].to(device), Cl[n].to(device), ctr[n].to(device)
+                self.set_init(obs_b[:, 0])
+                if latent:
+                    x_latent = self.pred_model.stat_en(self.in_nn)
+                for k in range(nt):
+                    t1 = default_timer()
+                    derivs = self.state_derivs(self.in_nn)
+                    if latent:
+                        x_latent = self.pred_model.latent_step(x_latent, ctr_b[:, k])
+                        out_pred, Cd_pred, Cl_pred = self.split_pred(self.pred_model.stat_de(x_latent))
+                        mod_pred = self.phys_model(self.in_nn, ctr_b[:, k], out_pred, derivs)
+                    else:
+                        out_pred, Cd_pred, Cl_pred, mod_pred, _, _, _ = self.model_step(self.in_nn, ctr_b[:, k], derivs, mode='pred')
+                    res = ((Lpde(self.in_nn, out_pred, self.dt, self.Re, derivs = derivs) + mod_pred) ** 2).cpu()
+                    if keep_fields:
+                        out_nn[n, k] = out_pred.cpu()
+                    else:
+                        res = res.reshape(res.shape[0], -1).mean(1)
+                    Lpde_pred[n, k] = res
+                    self.in_nn = out_pred
+                    error_cul[n, k] = rel_error(out_pred, obs_b[:, k+1]).cpu()
+                    error_Cd[n, k] = ((Cd_pred - Cd_b[:, k]) ** 2).cpu()
+                    error_Cl[n, k] = ((Cl_pred - Cl_b[:, k]) ** 2).cpu()
+                    t2 = default_timer()
+                    if k % 10 == 0:
+                        print(f'# {i} | {k} | {t2 - t1:1.2f}: error_Cd: {error_Cd[n, k].mean():1.4f} | error_Cl: {error_Cl[n, k].mean():1.4f} | \
+                                error_state: {error_cul[n, k].mean():1.4f}| cul_Lpde: {Lpde_pred[n, k].mean():1.4f}')
+
+        return out_nn, Lpde_pred, error_cul
 
 
 class NSEModel_FNO_prev(NSEModel_FNO):
@@ -311,18 +440,20 @@ class NSEModel_FNO_test(NSEModel_FNO):
     def scheduler_step(self):
         self.pred_scheduler.step()
     
-    def pred_loss(self, ipt, ctr, opt):
-        out, Cd, Cl = opt[:, :, :, :3], opt[:, 0, 0, -2], opt[:, 0, 0, -1]
+    def pred_loss(self, ipt, ctr, out, coef, derivs=None):
+        Cd, Cl = coef[:, 0], coef[:, 1]
+        if derivs is None:
+            derivs = self.state_derivs(ipt)
         # latent items
         out_latent = self.pred_model.stat_en(out)
         # prediction & rec items
-        out_pred, Cd_pred, Cl_pred, mod_pred, ipt_rec, ctr_rec, trans_out = self.model_step(ipt, ctr)
+        out_pred, Cd_pred, Cl_pred, mod_pred, ipt_rec, ctr_rec, trans_out = self.model_step(ipt, ctr, derivs)
         
         loss1 = rel_error(out_pred, out).mean() + rel_error(Cd_pred, Cd).mean() + rel_error(Cl_pred, Cl).mean()
         loss2 = rel_error(ipt_rec, ipt).mean()
-        loss3 = rel_error(ctr_rec, ctr).mean()
+        loss3 = rel_error(ctr_rec, expand_ctr(ctr, ipt.shape)).mean()
         loss4 = rel_error(trans_out, out_latent).mean()
-        loss6 = ((Lpde(ipt, out_pred, self.dt, Re = self.Re)) ** 2).mean()
+        loss6 = ((Lpde(ipt, out_pred, self.dt, Re = self.Re, derivs = derivs)) ** 2).mean()
 
         return loss1, loss2, loss3, loss4, loss6
 
@@ -335,27 +466,18 @@ class NSEModel_FNO_trivial(NSEModel_FNO):
         loss_pde = AverageMeter()
         t3 = default_timer()
 
-        for x_train, y_train in train_loader:
-            x_train = x_train.to(self.device)
-            y_train = y_train.to(self.device)
-
+        for batch in train_loader:
             # split data read in train_loader
-            in_new, ctr_new = x_train[:, :, :, :-1], x_train[:, 0, 0, -1]
-            opt_train = y_train
+            in_new, ctr_new, out_train, coef_train = self.split_batch(batch)
 
             self.phys_model.eval()
 
             in_train, ctr_train = self.gen_new_data(in_new, ctr_new, random)
-            ctr_train = ctr_train.reshape(ctr_train.shape[0], 1, 1, 1).repeat(1, self.nx, self.ny, 1)
             
             self.pred_model.train()
             self.pred_optimizer.zero_grad()
 
-            pred, _, _, _ = self.pred_model(in_train, ctr_train)
-            out_pred = pred[:, :, :, :3]
-            mod = self.phys_model(in_train, ctr_train, out_pred)
-            # 多训练几次？  
-            loss1, loss2, loss3, loss4, loss6 = self.pred_loss(in_train, ctr_train, opt_train)
+            loss1, loss2, loss3, loss4, loss6 = self.pred_loss(in_train, ctr_train, out_train, coef_train)
             lambda1, lambda2, lambda3, lambda4 = self.params.lambda1, self.params.lambda2, self.params.lambda3, self.params.lambda4
             loss = lambda1 * loss1 + lambda2 * loss2 + lambda3 * loss3 + lambda4 * loss4
             loss.backward()
@@ -375,12 +497,18 @@ class RBCModel(NSEModel):
         self.Re = 0.001
         self.set_model(FNO_ensemble_RBC, state_mo)
     
-    def pred_loss(self, ipt, ctr, opt):
-        out = opt[:, :, :, :3]
+    def split_batch(self, batch):
+        # RBC batches carry the control as a field: x = (ipt, ctr) [B, nx, ny, 4]
+        x, y = [item.to(self.device) for item in batch]
+        return x[:, :, :, :-1], x[:, :, :, -1].unsqueeze(-1), y[:, :, :, :3], None
+
+    def pred_loss(self, ipt, ctr, out, coef=None, derivs=None):
+        if derivs is None:
+            derivs = self.state_derivs(ipt)
         # latent items
         out_latent = self.pred_model.stat_en(out)
         # prediction & rec items
-        out_pred, mod_pred, ipt_rec, ctr_rec, trans_out = self.model_step(ipt, ctr)
+        out_pred, mod_pred, ipt_rec, ctr_rec, trans_out = self.model_step(ipt, ctr, derivs)
         # print((out**2).mean())
         # print(out_pred.max(), out.max())
         
@@ -388,66 +516,88 @@ class RBCModel(NSEModel):
         loss2 = rel_error(ipt_rec, ipt).mean()
         loss3 = rel_error(ctr_rec, ctr).mean()
         loss4 = rel_error(trans_out, out_latent).mean()
-        loss6 = ((Lpde(ipt, out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod_pred) ** 2).mean()
+        loss6 = ((Lpde(ipt, out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod_pred) ** 2).mean()
         # print(loss1, loss2, loss3, loss4, loss6)
         return loss1, loss2, loss3, loss4, loss6
 
-    def model_step(self, ipt, ctr):
-        pred, x_rec, ctr_rec, trans_out = self.pred_model(ipt, ctr)
+    def model_step(self, ipt, ctr, derivs=None, mode='train'):
+        pred, x_rec, ctr_rec, trans_out = self.pred_model(ipt, ctr, mode)
         # print(pred.max(), x_rec.max(), ctr_rec.max(), trans_out.max())
-        ipt_rec = x_rec[:, :, :, :3]
+        ipt_rec = x_rec[:, :, :, :3] if x_rec is not None else None
         out_pred = pred[:, :, :, :3]
-        mod_pred = self.phys_model(ipt, ctr, out_pred)
+        mod_pred = self.phys_model(ipt, ctr, out_pred, derivs)
         return out_pred, mod_pred, ipt_rec, ctr_rec, trans_out
 
-    def cal_1step(self, data):
+    def cal_1step(self, data, batch_size=16, keep_fields=False):
+        # same chunking / keep_fields as NSEModel_FNO.cal_1step
         obs, temp, ctr = data.get_data()
         N0, nt = obs.shape[0], obs.shape[1] - 1
         nx, ny = self.shape
         print(f'N0: {N0}, nt: {nt}, nx: {nx}, ny: {ny}')
-        out_nn, Lpde_obs, Lpde_pred = torch.zeros(N0, nt, nx, ny, 3), torch.zeros(N0, nt, nx, ny, 2), torch.zeros(N0, nt, nx, ny, 2)
+        batch_size = N0 if batch_size is None else batch_size
+        device = next(self.pred_model.parameters()).device
+        Lpde_shape = (N0, nt, nx, ny, 2) if keep_fields else (N0, nt)
+        Lpde_obs, Lpde_pred = torch.zeros(Lpde_shape), torch.zeros(Lpde_shape)
         error_1step = torch.zeros(N0, nt)
         with torch.no_grad():
-            for k in range(nt):
-                t1 = default_timer()
-                out_nn[:, k], mod_pred, _, _, _ = self.model_step(obs[:, k], ctr[:, k])
-                Lpde_pred[:, k] = ((Lpde(obs[:, k], out_nn[:, k], self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod_pred) ** 2)
-
-                mod_obs = self.phys_model(obs[:, k], ctr[:, k], obs[:, k+1])
-                Lpde_obs[:, k] = ((Lpde(obs[:, k], obs[:, k+1], self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod_obs) ** 2)
-                
-                error_1step[:, k] = rel_error(out_nn[:, k], obs[:, k+1]) 
-                t2 = default_timer()
-                if k % 10 == 0:
-                    print(f'# {k} | {t2 - t1:1.2f}: error_state: {error_1step[:, k].min():1.4f} {error_1step[:, k].max():1.4f} |\
-                            pred_Lpde: {Lpde_pred[:, k].mean():1.4f} | obs_Lpde: {Lpde_obs[:, k].mean():1.4f}')
+            for i in range(0, N0, batch_size):
+                n = slice(i, min(i + batch_size, N0))
+                obs_b, ctr_b = obs[n].to(device), ctr[n].to(device)
+                for k in range(nt):
+                    t1 = default_timer()
+                    derivs = self.state_derivs(obs_b[:, k])
+                    out_pred, mod_pred, _, _, _ = self.model_step(obs_b[:, k], ctr_b[:, k], derivs, mode='pred')
+                    res_pred = ((Lpde(obs_b[:, k], out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod_pred) ** 2).cpu()
+
+                    mod_obs = self.phys_model(obs_b[:, k], ctr_b[:, k], obs_b[:, k+1], derivs)
+                    res_obs = ((Lpde(obs_b[:, k], obs_b[:, k+1], self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod_obs) ** 2).cpu()
+                    if not keep_fields:
+                        res_pred, res_obs = res_pred.reshape(res_pred.shape[0], -1).mean(1), res_obs.reshape(res_obs.shape[0], -1).mean(1)
+                    Lpde_pred[n, k], Lpde_obs[n, k] = res_pred, res_obs
+
+                    error_1step[n, k] = rel_error(out_pred, obs_b[:, k+1]).cpu()
+                    t2 = default_timer()
+                    if k % 10 == 0:
+                        print(f'# {i} | {k} | {t2 - t1:1.2f}: error_state: {error_1step[n, k].min():1.4f} {error_1step[n, k].max():1.4f} |\
+                                pred_Lpde: {Lpde_pred[n, k].mean():1.4f} | obs_Lpde: {Lpde_obs[n, k].mean():1.4f}')
 
         return error_1step, Lpde_obs, Lpde_pred
 
-    def process(self, data):
+    def process(self, data, batch_size=16, keep_fields=False):
+        # same chunking / keep_fields / returns as NSEModel_FNO.process
         obs, temp, ctr = data.get_data()
-        init_k = 0
-        self.set_init(obs[:, init_k])
         print(f'obs: {obs.shape}', f'ctr: {ctr.shape}')
         N0, nt = obs.shape[0], obs.shape[1] - 1
         nx, ny = self.shape
         print(f'N0: {N0}, nt: {nt}, nx: {nx}, ny: {ny}')
-        out_nn, Lpde_pred = torch.zeros(N0, nt, nx, ny, 3), torch.zeros(N0, nt, nx, ny, 2)
+        batch_size = N0 if batch_size is None else batch_size
+        device = next(self.pred_model.parameters()).device
+        out_nn = torch.zeros(N0, nt, nx, ny, 3) if keep_fields else None
+        Lpde_pred = torch.zeros((N0, nt, nx, ny, 2) if keep_fields else (N0, nt))
         error_cul = torch.zeros(N0, nt)
         with torch.no_grad():
-            for k in range(init_k, nt):
-                t1 = default_timer()
-                out_nn[:, k], mod_pred, _, _, _ = self.model_step(self.in_nn, ctr[:, k])
-                # print(pred.shape, mod_pred.shape, self.in_nn.shape)
-                Lpde_pred[:, k] = ((Lpde(self.in_nn, out_nn[:, k], self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly) + mod_pred) ** 2)
-                self.in_nn = out_nn[:, k]
-                error_cul[:, k] = rel_error(out_nn[:, k], obs[:, k+1]) 
-                t2 = default_timer()
-                if k % 10 == 0:
-                    print(f'# {k} | {t2 - t1:1.2f}: error_state: {error_cul[:, k].min():1.4f} {error_cul[:, k].max():1.4f} |\
-                            cul_Lpde: {Lpde_pred[:, k].mean():1.4f}')
-
-        return out_nn, Lpde_pred
+            for i in range(0, N0, batch_size):
+                n = slice(i, min(i + batch_size, N0))
+                obs_b, ctr_b = obs[n].to(device), ctr[n].to(device)
+                self.set_init(obs_b[:, 0])
+                for k in range(nt):
+                    t1 = default_timer()
+                    derivs = self.state_derivs(self.in_nn)
+                    out_pred, mod_pred, _, _, _ = self.model_step(self.in_nn, ctr_b[:, k], derivs, mode='pred')
+                    res = ((Lpde(self.in_nn, out_pred, self.dt, Re = self.Re, Lx = self.Lx, Ly = self.Ly, derivs = derivs) + mod_pred) ** 2).cpu()
+                    if keep_fields:
+                        out_nn[n, k] = out_pred.cpu()
+                    else:
+                        res = res.reshape(res.shape[0], -1).mean(1)
+                    Lpde_pred[n, k] = res
+                    self.in_nn = out_pred
+                    error_cul[n, k] = rel_error(out_pred, obs_b[:, k+1]).cpu()
+                    t2 = default_timer()
+                    if k % 10 == 0:
+                        print(f'# {i} | {k} | {t2 - t1:1.2f}: error_state: {error_cul[n, k].min():1.4f} {error_cul[n, k].max():1.4f} |\
+                                cul_Lpde: {Lpde_pred[n, k].mean():1.4f}')
+
+        return out_nn, Lpde_pred, error_cul
 
 
 class RBCModel_FNO(RBCModel):
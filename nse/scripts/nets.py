@@ -12,6 +12,107 @@ class SpectralConv2d(nn.Module):
     def __init__(self, in_channels, out_channels, modes1, modes2):
         super(SpectralConv2d, self).__init__()
 
+        """
+        2D Fourier layer. It does FFT, linear transform, and Inverse FFT.    
+        Truncated transforms: rfft along y keeps the modes2 columns, the x transforms only run over those columns
+        and irfft(n=ny) pads the rest. use_dft replaces the x transforms by (2 * modes1, nx) DFT matmuls.
+        Without autograd the zero-padded spectrum is a buffer cached per input shape.
+        """
+
+        self.in_channels = in_channels
+        self.out_channels = out_channels
+        self.modes1 = modes1    # Number of Fourier modes to multiply, at most floor(N/2) + 1
+        self.modes2 = modes2
+
+        self.scale = (1 / (in_channels * out_channels))
+        # weights[0]: top x-modes, weights[1]: bottom x-modes (weights1 / weights2 of older checkpoints)
+        self.weights = nn.Parameter(self.scale * torch.rand(2, in_channels, out_channels, self.modes1, self.modes2, dtype=torch.cfloat))
+        self._register_load_state_dict_pre_hook(self.stack_weights)
+        self.dft_cache = dict()
+        self.buf_cache = dict()
+        self.use_dft = False
+
+    def stack_weights(self, state_dict, prefix, *args):
+        w1, w2 = prefix + 'weights1', prefix + 'weights2'
+        if w1 in state_dict:
+            state_dict[prefix + 'weights'] = torch.stack((state_dict.pop(w1), state_dict.pop(w2)))
+
+    def get_dft(self, nx, device):
+        # forward (2 * modes1, nx) and inverse (nx, 2 * modes1) DFT over the kept x-modes, built once per shape
+        key = (nx, device)
+        if key not in self.dft_cache:
+            k = torch.cat((torch.arange(self.modes1), torch.arange(nx - self.modes1, nx))).to(device, torch.float64)
+            x = torch.arange(nx, device=device, dtype=torch.float64)
+            phase = 2 * np.pi * torch.outer(k, x) / nx
+            fwd = torch.polar(torch.ones_like(phase), -phase).to(torch.cfloat)
+            inv = (torch.polar(torch.ones_like(phase), phase) / nx).T.contiguous().to(torch.cfloat)
+            self.dft_cache[key] = (fwd, inv)
+        return self.dft_cache[key]
+
+    def get_buf(self, batchsize, nx, device):
+        # (batch, out_channel, nx, modes2) spectrum, only rows :m1 / -m1: are ever written so the rest stays 0.
+        # Reused only without autograd: written in place under grad it would chain onto the previous call's graph
+        shape = (batchsize, self.out_channels, nx, self.modes2)
+        if torch.is_grad_enabled() or torch.jit.is_tracing():
+            return torch.zeros(shape, dtype=torch.cfloat, device=device)
+        key = (batchsize, nx, device)
+        if key not in self.buf_cache:
+            self.buf_cache[key] = torch.zeros(shape, dtype=torch.cfloat, device=device)
+        return self.buf_cache[key]
+
+    # Complex multiplication
+    def compl_mul2d(self, input, weights):
+        # (2, x, y, batch, in_channel), (2, x, y, in_channel, out_channel) -> (2, x, y, batch, out_channel)
+        return torch.matmul(input, weights)
+
+    def forward_full(self, x):
+        # full rfft2 / irfft2, for grids where the top and bottom mode blocks overlap (2 * modes1 > nx)
+        batchsize = x.shape[0]
+        x_ft = torch.fft.rfft2(x)
+        out_ft = torch.zeros(batchsize, self.out_channels,  x.size(-2), x.size(-1)//2 + 1, dtype=torch.cfloat, device=x.device)
+        out_ft[:, :, :self.modes1, :self.modes2] = \
+            torch.einsum("bixt,ioxt->boxt", x_ft[:, :, :self.modes1, :self.modes2], self.weights[0])
+        out_ft[:, :, -self.modes1:, :self.modes2] = \
+            torch.einsum("bixt,ioxt->boxt", x_ft[:, :, -self.modes1:, :self.modes2], self.weights[1])
+        return torch.fft.irfft2(out_ft, s=(x.size(-2), x.size(-1)))
+
+    def forward(self, x):
+        batchsize = x.shape[0]
+        nx, ny = x.size(-2), x.size(-1)
+        m1, m2 = self.modes1, self.modes2
+        if 2 * m1 > nx:
+            # top and bottom mode blocks overlap
+            return self.forward_full(x)
+
+        #Compute Fourier coeffcients up to factor of e^(- something constant)
+        x_ft = torch.fft.rfft(x)[..., :m2]
+        if self.use_dft:
+            fwd, inv = self.get_dft(nx, x.device)
+            x_ft = torch.matmul(fwd, x_ft)    # (batch, in_channel, 2 * m1, m2)
+        else:
+            x_ft = torch.fft.fft(x_ft, dim=-2)
+            x_ft = torch.cat((x_ft[..., :m1, :], x_ft[..., -m1:, :]), dim=-2)
+
+        # Multiply relevant Fourier modes, both blocks in one batched matmul
+        x_ft = x_ft.reshape(batchsize, self.in_channels, 2, m1, m2).permute(2, 3, 4, 0, 1)
+        out_ft = self.compl_mul2d(x_ft, self.weights.permute(0, 3, 4, 1, 2))
+        out_ft = out_ft.permute(3, 4, 0, 1, 2).reshape(batchsize, self.out_channels, 2 * m1, m2)
+
+        #Return to physical space
+        if self.use_dft:
+            x = torch.matmul(inv, out_ft)
+        else:
+            x = self.get_buf(batchsize, nx, out_ft.device)
+            x[..., :m1, :], x[..., -m1:, :] = out_ft[..., :m1, :], out_ft[..., m1:, :]
+            x = torch.fft.ifft(x, dim=-2)
+        x = torch.fft.irfft(x, n=ny)
+        return x
+
+
+class SpectralConv2d_prev(nn.Module):
+    def __init__(self, in_channels, out_channels, modes1, modes2):
+        super(SpectralConv2d_prev, self).__init__()
+
         """
         2D Fourier layer. It does FFT, linear transform, and Inverse FFT.    
         """
@@ -308,18 +409,16 @@ class state_mo(nn.Module):
         # self.fc2 = nn.Linear(128, 3)
         self.fc2 = nn.Linear(128, 2)
 
-    def forward(self, x, ctr, x_next):
+    def forward(self, x, ctr, x_next, derivs=None):
         grid = self.get_grid(x.shape, x.device) # 2
-        # ctr # 1
+        ctr = expand_ctr(ctr, x.shape) # 1
         u_bf = x[..., :-1]   # 2
-        p_bf = x[..., -1].reshape(-1, x.shape[1], x.shape[2], 1)
         u_af = x_next[..., :-1]  # 2
-        ux, uy = fdmd2D(u_bf, x.device, self.Lx, self.Ly)   # input 2 + 2
-        px, py = fdmd2D(p_bf, x.device, self.Lx, self.Ly)
-        uxx, _ = fdmd2D(ux, x.device, self.Lx, self.Ly)
-        _, uyy = fdmd2D(uy, x.device, self.Lx, self.Ly) 
-        u_lap = uxx + uyy   # input 2
-        p_grad = torch.cat((px, py), -1)    # input 2
+        if derivs is None:
+            derivs = StateDerivs(x, self.Lx, self.Ly)
+        ux, uy = derivs.ux, derivs.uy   # input 2 + 2
+        u_lap = derivs.u_lap   # input 2
+        p_grad = derivs.p_grad    # input 2
         ipt = torch.cat((grid, u_bf, ctr, u_af, ux, uy, p_grad, u_lap), -1)
         opt = self.fc0(ipt).permute(0, 3, 1, 2)
         opt = self.net(opt).permute(0, 2, 3, 1)
@@ -360,6 +459,12 @@ class state_mo_prev(nn.Module):
         return x
 
 
+def decode_pair(decoder, x_latent, trans_out):
+    # x_rec and pred through the decoder as one concatenated batch (no batch statistics are used)
+    out = decoder(torch.cat((x_latent, trans_out), dim=0))
+    return out.split(x_latent.shape[0], dim=0)
+
+
 class FNO_ensemble(nn.Module):
     def __init__(self, params):
         super(FNO_ensemble, self).__init__()
@@ -383,20 +488,28 @@ class FNO_ensemble(nn.Module):
         self.trans = trans_net(modes1, modes2, width, L, f_channels)
 
     # def forward(self, x, f, modify=True):
-    def forward(self, x, ctr):
-        # x: [batch_size, nx, ny, 3]; f: [1]
+    def forward(self, x, ctr, mode='train'):
+        # x: [batch_size, nx, ny, 3]; ctr: [batch_size, 1] or [batch_size, nx, ny, 1]
+        # mode 'pred': prediction path only, x_rec / ctr_rec are returned as None
         x_latent = self.stat_en(x)
-        x_rec = self.stat_de(x_latent)
 
+        ctr = expand_ctr(ctr, x.shape)
         ctr_latent = self.ctr_en(ctr)
-        ctr_rec = self.ctr_de(ctr_latent)
 
         trans_out = self.trans(x_latent, ctr_latent)
-        
-        pred = self.stat_de(trans_out)
+        if mode == 'pred':
+            return self.stat_de(trans_out), None, None, trans_out
+
+        ctr_rec = self.ctr_de(ctr_latent)
+        x_rec, pred = decode_pair(self.stat_de, x_latent, trans_out)
         
         return pred, x_rec, ctr_rec, trans_out #, mod
 
+    def latent_step(self, x_latent, ctr):
+        # x_latent: [batch_size, width, nx, ny] -> next latent state, no decode / re-encode
+        ctr = expand_ctr(ctr, (x_latent.shape[0], x_latent.shape[2], x_latent.shape[3]))
+        return self.trans(x_latent, self.ctr_en(ctr))
+
 
 class FNO_ensemble_test(nn.Module):
     def __init__(self, params):
@@ -420,20 +533,24 @@ class FNO_ensemble_test(nn.Module):
         self.trans = trans_net(modes1, modes2, width, L, f_channels)
 
     # def forward(self, x, f, modify=True):
-    def forward(self, x, ctr):
-        # x: [batch_size, nx, ny, 3]; f: [1]
+    def forward(self, x, ctr, mode='train'):
+        # x: [batch_size, nx, ny, 3]; ctr: [batch_size, 1] or [batch_size, nx, ny, 1]
+        # mode 'pred': prediction path only, x_rec / ctr_rec are returned as None
         x_latent = self.stat_en(x)
-        x_rec = self.stat_de(x_latent)
 
+        ctr = expand_ctr(ctr, x.shape)
         ctr_latent = self.ctr_en(ctr)
-        ctr_rec = self.ctr_de(ctr_latent)
 
         trans_out = self.trans(x_latent, ctr_latent)
-        mod = self.state_mo(trans_out)
-        
+        if mode == 'pred':
+            return self.stat_de(trans_out), None, None, trans_out
+
+        x_rec = self.stat_de(x_latent)
+        ctr_rec = self.ctr_de(ctr_latent)
         pred = self.stat_de(trans_out)
         
-        return pred, x_rec, ctr_rec, trans_out, mod
+        # same outputs as FNO_ensemble, the state_mo_prev output was never consumed by NSEModel
+        return pred, x_rec, ctr_rec, trans_out
 
 
 class FNO_ensemble_RBC(nn.Module):
@@ -459,21 +576,27 @@ class FNO_ensemble_RBC(nn.Module):
         self.trans = trans_net(modes1, modes2, width, L, f_channels)
 
     # def forward(self, x, f, modify=True):
-    def forward(self, x, ctr):
+    def forward(self, x, ctr, mode='train'):
         # x: [batch_size, nx, ny, 3]; f: [1]
         x_latent = self.stat_en(x)
-        x_rec = self.stat_de(x_latent)
 
-        # ctr encode & decode
+        # ctr encode
         ctr_latent = self.ctr_en(ctr)
-        ctr_rec = self.ctr_de(ctr_latent)
 
         # trans layer
         trans_out = self.trans(x_latent, ctr_latent)
-        pred = self.stat_de(trans_out)
+        if mode == 'pred':
+            return self.stat_de(trans_out), None, None, trans_out
+
+        # ctr decode & both state decodes in one batch
+        ctr_rec = self.ctr_de(ctr_latent)
+        x_rec, pred = decode_pair(self.stat_de, x_latent, trans_out)
         
         return pred, x_rec, ctr_rec, trans_out #, mod
 
+    def latent_step(self, x_latent, ctr):
+        return self.trans(x_latent, self.ctr_en(ctr))
+
 
 class FNO_ensemble_RBC1(nn.Module):
     def __init__(self, params):
@@ -493,12 +616,86 @@ class FNO_ensemble_RBC1(nn.Module):
         self.trans = trans_net(modes1, modes2, width, L, f_channels)
 
     # def forward(self, x, f, modify=True):
-    def forward(self, x, ctr):
+    def forward(self, x, ctr, mode='train'):
         # x: [batch_size, nx, ny, 3]; f: [1]
         x_latent = self.stat_en(x)
-        x_rec = self.stat_de(x_latent)
         
         ctr_latent = ctr.permute(0, 3, 1, 2)
         trans_out = self.trans(x_latent, ctr_latent)
-        pred = self.stat_de(trans_out)
+        if mode == 'pred':
+            return self.stat_de(trans_out), None, None, trans_out
+
+        x_rec, pred = decode_pair(self.stat_de, x_latent, trans_out)
         return pred, x_rec, ctr, trans_out
+
+    def latent_step(self, x_latent, ctr):
+        return self.trans(x_latent, ctr.permute(0, 3, 1, 2))
+
+
+#===========================================================================
+# inference export / compile
+#===========================================================================
+class FNO_ensemble_infer(nn.Module):
+    """
+    Prediction path of FNO_ensemble / FNO_ensemble_RBC / FNO_ensemble_RBC1 for a fixed (nx, ny), the encoder grid
+    is precomputed, so the module can be traced by torch.jit.trace.
+    forward(x, ctr): x [batch_size, nx, ny, 3]; ctr [batch_size] (NSE) or [batch_size, nx, ny, 1] (RBC)
+    -> pred [batch_size, nx, ny, C]
+    """
+    def __init__(self, model, shape):
+        super(FNO_ensemble_infer, self).__init__()
+        self.nx, self.ny = shape
+        self.stat_en, self.stat_de, self.trans = model.stat_en, model.stat_de, model.trans
+        self.ctr_en = getattr(model, 'ctr_en', None)
+        self.ctr_field = not isinstance(model, FNO_ensemble)
+        self.register_buffer('grid', model.stat_en.get_grid((1, self.nx, self.ny), 'cpu'))
+
+    def forward(self, x, ctr):
+        x = torch.cat((x, self.grid.expand(x.shape[0], -1, -1, -1)), dim=-1)
+        x_latent = self.stat_en.down(self.stat_en.fc0(x).permute(0, 3, 1, 2))
+        if not self.ctr_field:
+            ctr = ctr.reshape(-1, 1, 1, 1).expand(-1, self.nx, self.ny, 1)
+        ctr_latent = self.ctr_en(ctr) if self.ctr_en is not None else ctr.permute(0, 3, 1, 2)
+        return self.stat_de(self.trans(x_latent, ctr_latent))
+
+
+class state_mo_infer(nn.Module):
+    """
+    state_mo for a fixed (nx, ny) with the grid precomputed and the derivatives of x computed inside.
+    forward(x, ctr, x_next): x, x_next [batch_size, nx, ny, 3]; ctr [batch_size] -> [batch_size, nx, ny, 2]
+    """
+    def __init__(self, model, shape, scheme='forward'):
+        super(state_mo_infer, self).__init__()
+        self.nx, self.ny = shape
+        self.model = model
+        self.scheme = scheme
+        self.register_buffer('grid', model.get_grid((1, self.nx, self.ny), 'cpu'))
+
+    def forward(self, x, ctr, x_next):
+        derivs = StateDerivs(x, self.model.Lx, self.model.Ly, self.scheme)
+        ctr = ctr.reshape(-1, 1, 1, 1).expand(-1, self.nx, self.ny, 1)
+        ipt = torch.cat((self.grid.expand(x.shape[0], -1, -1, -1), x[..., :-1], ctr, x_next[..., :-1],
+                         derivs.ux, derivs.uy, derivs.p_grad, derivs.u_lap), -1)
+        opt = self.model.fc0(ipt).permute(0, 3, 1, 2)
+        opt = self.model.net(opt).permute(0, 2, 3, 1)
+        return self.model.fc2(F.gelu(self.model.fc1(opt)))
+
+
+def compile_model(model, mode='default'):
+    # torch.compile when available (torch >= 2.0), eager model otherwise
+    if hasattr(torch, 'compile'):
+        return torch.compile(model, mode=mode)
+    return model
+
+
+def export_model(model, example_inputs, path=None):
+    """
+    Export an inference wrapper (FNO_ensemble_infer / state_mo_infer) traced at the shapes of example_inputs
+    with torch.jit.trace, returned and saved to path. ONNX is not supported: SpectralConv2d has cfloat weights.
+    """
+    model = model.eval()
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example_inputs))
+    if path is not None:
+        traced.save(path)
+    return traced
@@ -37,7 +37,10 @@ def loss_log(data, file_name, test_rate = 0.2):
     data.unnormalize()
     torch.save(loss, 'logs/data/losslog/loss_log_' + file_name)
 
-def test_log(data, file_name, ex_name, model_loaded = NSEModel_FNO, dict = 'nse', dt = 0.05):
+def test_log(data, file_name, ex_name, model_loaded = NSEModel_FNO, dict = 'nse', dt = 0.05, batch_size = 16, keep_fields = True):
+    # batch_size: trajectories per chunk of cal_1step / process
+    # keep_fields: full out_cul / Lpde fields for the field plots (4_anime, draw_utils), O(N0) memory;
+    # False logs out_cul = None and the (N0, nt) means of the Lpde terms
     N0, nt, nx, ny = data.get_params()
     shape = [nx, ny]
 
@@ -51,14 +54,8 @@ def test_log(data, file_name, ex_name, model_loaded = NSEModel_FNO, dict = 'nse'
     model.load_state(state_dict_pred, state_dict_phys)
     model.toCPU()
     
-    obs = data.get_obs()
-
-    error_1step, Lpde_obs, Lpde_pred = model.cal_1step(data)
-    out_cul, Lpde_pred_cul = model.process(data)
-    
-    error_cul = torch.zeros(N0, nt)
-    for k in range(nt):
-        error_cul[:, k] = rel_error(out_cul[:, k], obs[:, 1+k])
+    error_1step, Lpde_obs, Lpde_pred = model.cal_1step(data, batch_size, keep_fields)
+    out_cul, Lpde_pred_cul, error_cul = model.process(data, batch_size=batch_size, keep_fields=keep_fields)
     # print(f'Lpde_nn: {Lpde_pred_cul[-1]}')
     
     data.unnormalize()
@@ -3,6 +3,7 @@ import torch
 import operator
 import numpy as np
 import os, sys
+import json
 from functools import reduce
 from torch.utils.data.distributed import DistributedSampler
 from torch.utils.data import Dataset, DataLoader
@@ -51,7 +52,42 @@ def count_params(model):
         c += reduce(operator.mul, list(p.size()))
     return c
 
-def Lpde(state_bf, state_af, dt, Re = 0.001, Lx = 2.2, Ly = 0.41):
+class StateDerivs:
+    """
+    Spatial derivatives of a state (u, v, p), computed once and shared by Lpde and state_mo.
+    <ARGS>
+    state : torch.Tensor shape of (B, nx, ny, 3)
+    <ATTRS>
+    ux, uy, u_lap : torch.Tensor shape of (B, nx, ny, 2)
+    p_grad : torch.Tensor shape of (B, nx, ny, 2), (px, py)
+    """
+    def __init__(self, state, Lx, Ly, scheme='forward'):
+        device = state.device
+        if scheme == 'spectral':
+            # u and p in one transform pass
+            d_x, d_y, d_lap, _ = SpectralDerivative.get(state.shape[1], state.shape[2], Lx, Ly, device, state.dtype)(state)
+            self.ux, self.uy = d_x[..., :2], d_y[..., :2]
+            self.u_lap = d_lap[..., :2]
+            self.p_grad = torch.cat((d_x[..., -1:], d_y[..., -1:]), -1)
+            return
+
+        u = state[..., :2]
+        p = state[..., -1:]
+        self.ux, self.uy = fdmd2D(u, device, Lx, Ly, scheme)
+        px, py = fdmd2D(p, device, Lx, Ly, scheme)
+        uxx, _ = fdmd2D(self.ux, device, Lx, Ly, scheme)
+        _, uyy = fdmd2D(self.uy, device, Lx, Ly, scheme)
+        self.u_lap = uxx + uyy
+        self.p_grad = torch.cat((px, py), -1)
+
+    def repeat(self, n):
+        # derivatives of torch.cat([state] * n), without recomputing them
+        derivs = StateDerivs.__new__(StateDerivs)
+        for name in ['ux', 'uy', 'u_lap', 'p_grad']:
+            setattr(derivs, name, getattr(self, name).repeat(n, 1, 1, 1))
+        return derivs
+
+def Lpde(state_bf, state_af, dt, Re = 0.001, Lx = 2.2, Ly = 0.41, scheme = 'forward', derivs = None):
     # print(dt, Re, Lx, Ly)
     nx = state_bf.shape[1]
     ny = state_bf.shape[2]
@@ -64,13 +100,9 @@ def Lpde(state_bf, state_af, dt, Re = 0.001, Lx = 2.2, Ly = 0.41):
     # ux, uy, u_lap = fftd2D(u_bf, device)
     # px, py, _ = fftd2D(p_bf, device)
 
-    ux, uy = fdmd2D(u_bf, device, Lx, Ly)
-    px, py = fdmd2D(p_bf, device, Lx, Ly)
-    uxx, _ = fdmd2D(ux, device, Lx, Ly)
-    _, uyy = fdmd2D(uy, device, Lx, Ly)
-
-    u_lap = uxx + uyy
-    p_grad = torch.cat((px, py), -1)
+    if derivs is None:
+        derivs = StateDerivs(state_bf, Lx, Ly, scheme)
+    ux, uy, u_lap, p_grad = derivs.ux, derivs.uy, derivs.u_lap, derivs.p_grad
     L_state = (u_af - u_bf) / dt + u_bf[..., 0].reshape(-1, nx, ny, 1) * ux + \
               u_bf[..., 1].reshape(-1, nx, ny, 1) * uy - Re * u_lap + p_grad
 
@@ -79,7 +111,7 @@ def Lpde(state_bf, state_af, dt, Re = 0.001, Lx = 2.2, Ly = 0.41):
 
     return L_state
 
-def Lpde_rbc(state_bf, state_af, temp, dt, Re = 0.001, Lx = 2.0, Ly = 2.0):
+def Lpde_rbc(state_bf, state_af, temp, dt, Re = 0.001, Lx = 2.0, Ly = 2.0, scheme = 'forward', derivs = None):
     # print(dt, Re, Lx, Ly)
     nx = state_bf.shape[1]
     ny = state_bf.shape[2]
@@ -94,13 +126,9 @@ def Lpde_rbc(state_bf, state_af, temp, dt, Re = 0.001, Lx = 2.0, Ly = 2.0):
     # ux, uy, u_lap = fftd2D(u_bf, device)
     # px, py, _ = fftd2D(p_bf, device)
 
-    ux, uy = fdmd2D(u_bf, device, Lx, Ly)
-    px, py = fdmd2D(p_bf, device, Lx, Ly)
-    uxx, _ = fdmd2D(ux, device, Lx, Ly)
-    _, uyy = fdmd2D(uy, device, Lx, Ly)
-
-    u_lap = uxx + uyy
-    p_grad = torch.cat((px, py), -1)
+    if derivs is None:
+        derivs = StateDerivs(state_bf, Lx, Ly, scheme)
+    ux, uy, u_lap, p_grad = derivs.ux, derivs.uy, derivs.u_lap, derivs.p_grad
     L_state = (u_af - u_bf) / dt + u_bf[..., 0].reshape(-1, nx, ny, 1) * ux + \
               u_bf[..., 1].reshape(-1, nx, ny, 1) * uy - Re * u_lap + p_grad - temp
 
@@ -109,49 +137,100 @@ def Lpde_rbc(state_bf, state_af, temp, dt, Re = 0.001, Lx = 2.0, Ly = 2.0):
 
     return L_state
 
-def fdmd2D(u, device, Lx, Ly):
-    bs = u.shape[0]
+def expand_ctr(ctr, shape):
+    # per-sample control [B] / [B, 1] -> [B, nx, ny, 1] view on its device; fields pass through
+    if ctr.dim() == 4:
+        return ctr
+    return ctr.reshape(-1, 1, 1, 1).expand(-1, shape[1], shape[2], 1)
+
+def fdmd2D(u, device, Lx, Ly, scheme='forward'):
+    """
+    <ARGS>
+    u : torch.Tensor shape of (B, nx, ny, dimu)
+    scheme : 'forward' (1st order, last column copied), 'central' (2nd order) or 'central4' (4th order interior)
+    <RETURN>
+    ux, uy : torch.Tensor shape of (B, nx, ny, dimu)
+    """
     nx = u.shape[1]
     ny = u.shape[2]
-    dimu = u.shape[-1]
     dx = Lx / nx
     dy = Ly / ny
-    ux = torch.zeros(bs, nx, ny, dimu).to(device)
-    uy = torch.zeros(bs, nx, ny, dimu).to(device)
-    for i in range(nx-1):
-        ux[:, i] = (u[:, i+1] - u[:, i]) / dx
-    ux[:, -1] = ux[:, -2]
-    for j in range(ny-1):
-        uy[:, :, j] = (u[:, :, j+1] - u[:, :, j]) / dy
-    uy[:, :, -1] = uy[:, :, -2]
+    u = u.to(device)
+    if scheme == 'forward':
+        ux = torch.diff(u, dim=1) / dx
+        ux = torch.cat((ux, ux[:, -1:]), dim=1)
+        uy = torch.diff(u, dim=2) / dy
+        uy = torch.cat((uy, uy[:, :, -1:]), dim=2)
+    elif scheme == 'central':
+        ux = torch.gradient(u, spacing=dx, dim=1, edge_order=2)[0]
+        uy = torch.gradient(u, spacing=dy, dim=2, edge_order=2)[0]
+    elif scheme == 'central4':
+        ux = central4(u, dx, 1)
+        uy = central4(u, dy, 2)
+    else:
+        raise ValueError(f'unknown finite difference scheme: {scheme}')
 
     return ux, uy
 
-def fftd2D(u, device):
+def central4(u, h, dim):
+    # 4th order central stencil inside, 2nd order (torch.gradient) on the two outer points at each side
+    du = torch.gradient(u, spacing=h, dim=dim, edge_order=2)[0]
+    n = u.shape[dim]
+    if n < 5:
+        return du
+    um2, um1 = u.narrow(dim, 0, n-4), u.narrow(dim, 1, n-4)
+    up1, up2 = u.narrow(dim, 3, n-4), u.narrow(dim, 4, n-4)
+    inner = (um2 - 8 * um1 + 8 * up1 - up2) / (12 * h)
+    return torch.cat((du.narrow(dim, 0, 2), inner, du.narrow(dim, n-2, 2)), dim=dim)
+
+class SpectralDerivative:
+    """
+    Spectral derivatives on a periodic (nx, ny) grid of size (Lx, Ly). Wavenumber buffers are built once per
+    (nx, ny, Lx, Ly, device, dtype) and shared through SpectralDerivative.get.
+    """
+    cache = dict()
+
+    @classmethod
+    def get(cls, nx, ny, Lx, Ly, device, dtype=torch.float32):
+        key = (nx, ny, Lx, Ly, torch.device(device), dtype)
+        if key not in cls.cache:
+            cls.cache[key] = cls(nx, ny, Lx, Ly, device, dtype)
+        return cls.cache[key]
+
+    def __init__(self, nx, ny, Lx, Ly, device, dtype=torch.float32):
+        self.nx, self.ny = nx, ny
+        k_x = torch.fft.fftfreq(nx, d=Lx / nx, device=device, dtype=dtype) * 2 * torch.pi
+        k_y = torch.fft.rfftfreq(ny, d=Ly / ny, device=device, dtype=dtype) * 2 * torch.pi
+        self.k_x = k_x.reshape(1, nx, 1, 1)
+        self.k_y = k_y.reshape(1, 1, -1, 1)
+        self.lap = -(self.k_x ** 2 + self.k_y ** 2)
+        # the Nyquist mode of a real field has no well-defined first derivative
+        self.ik_x, self.ik_y = 1j * self.k_x, 1j * self.k_y
+        if nx % 2 == 0:
+            self.ik_x[:, nx // 2] = 0
+        if ny % 2 == 0:
+            self.ik_y[:, :, -1] = 0
+
+    def __call__(self, u):
+        """
+        <ARGS>
+        u : torch.Tensor shape of (B, nx, ny, dimu)
+        <RETURN>
+        ux, uy, u_lap : torch.Tensor shape of (B, nx, ny, dimu)
+        div : torch.Tensor shape of (B, nx, ny, 1) if dimu == 2 else None
+        """
+        u_h = torch.fft.rfft2(u, dim=(1, 2))
+        # one inverse transform for all three derivatives
+        d_h = torch.stack((self.ik_x * u_h, self.ik_y * u_h, self.lap * u_h))
+        ux, uy, u_lap = torch.fft.irfft2(d_h, s=(self.nx, self.ny), dim=(2, 3)).unbind(0)
+        div = ux[..., :1] + uy[..., 1:] if u.shape[-1] == 2 else None
+
+        return ux, uy, u_lap, div
+
+def fftd2D(u, device, Lx = 2.2, Ly = 0.41):
     nx = u.shape[-3]
     ny = u.shape[-2]
-    dimu = u.shape[-1]
-    u_h = torch.fft.fft2(u, dim=[1, 2]).reshape(-1, nx, ny, dimu)
-
-    k_x = torch.arange(-nx//2, nx//2) * 2 * torch.pi / 2.2
-    k_y = torch.arange(-ny//2, ny//2) * 2 * torch.pi / 0.41
-    k_x = torch.fft.fftshift(k_x)
-    k_y = torch.fft.fftshift(k_y)
-    k_x = k_x.reshape(nx, 1).repeat(1, ny).reshape(1,nx,ny,1).to(device)
-    k_y = k_y.reshape(1, ny).repeat(nx, 1).reshape(1,nx,ny,1).to(device)
-    lap = -(k_x ** 2 + k_y ** 2)
-
-    ux_h = 1j * k_x * u_h
-    uy_h = 1j * k_y * u_h
-    ulap_h = lap * u_h
-
-    ux = torch.fft.ifft2(ux_h, dim=[1, 2])
-    uy = torch.fft.ifft2(uy_h, dim=[1, 2])
-    u_lap = torch.fft.ifft2(ulap_h, dim=[1, 2])
-
-    ux = torch.real(ux).reshape(-1, nx, ny, dimu)
-    uy = torch.real(uy).reshape(-1, nx, ny, dimu)
-    u_lap = torch.real(u_lap).reshape(-1, nx, ny, dimu)
+    ux, uy, u_lap, _ = SpectralDerivative.get(nx, ny, Lx, Ly, device, u.dtype)(u.to(device))
 
     return ux, uy, u_lap
 
@@ -219,9 +298,85 @@ class PredLog():
         logs['test_loss_pde_pred'].append(self.loss6.avg)
 
 
+class TrajWriter:
+    """
+    Chunked, resumable dataset writer. Every field is a memory-mapped .npy of shape (N0, *traj_shape)
+    inside the directory `path`; manifest.json records the field shapes and the finished trajectories.
+    <ARGS>
+    path : str, dataset directory
+    fields : dict {name: shape}, creates (or reopens with resume) the dataset; None opens an existing one for writing
+    resume : bool, keep the trajectories already finished in `path`, the fields must match the manifest
+    """
+    def __init__(self, path, fields=None, resume=False, dtype=np.float32):
+        self.path = path
+        self.manifest_path = os.path.join(path, 'manifest.json')
+
+        if fields is None or (resume and os.path.exists(self.manifest_path)):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+            mode = 'r+'
+            if fields is not None:
+                shapes = {name: list(shape) for name, shape in fields.items()}
+                if shapes != self.manifest['fields']:
+                    raise ValueError(f'resume of {path}: fields {shapes} do not match the manifest {self.manifest["fields"]}')
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.manifest = {'fields': {name: list(shape) for name, shape in fields.items()},
+                             'dtype': np.dtype(dtype).name, 'done': []}
+            mode = 'w+'
+
+        self.data = dict()
+        for name, shape in self.manifest['fields'].items():
+            self.data[name] = np.lib.format.open_memmap(os.path.join(path, f'{name}.npy'), mode=mode,
+                                                        dtype=self.manifest['dtype'], shape=tuple(shape))
+        if mode == 'w+':
+            self.save_manifest()
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def is_done(self, idx):
+        return idx in self.manifest['done']
+
+    def write(self, idx, **arrays):
+        for name, value in arrays.items():
+            self.data[name][idx] = value
+            self.data[name].flush()
+
+    def commit(self, idx):
+        # only the owner process commits, after all fields of trajectory idx are written
+        if not self.is_done(idx):
+            self.manifest['done'].append(int(idx))
+        self.save_manifest()
+
+    def save_manifest(self):
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def to_tensor(self, name):
+        # shares memory with the memory-mapped file, no extra copy
+        return torch.from_numpy(self.data[name])
+
+
+def load_traj(path):
+    # fields of a TrajWriter dataset as tensors backed by copy-on-write memory maps (nothing is read up front)
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    return [torch.from_numpy(np.load(os.path.join(path, f'{name}.npy'), mmap_mode='c')) for name in manifest['fields']]
+
+
 class LoadData:
-    def __init__(self, data_path):
-        self.data = torch.load(data_path)
+    def __init__(self, data_path, lazy=False):
+        # lazy: memory-map the data and slice samples on demand instead of materialising the training set
+        self.lazy = lazy
+        if os.path.isdir(data_path):
+            self.data = load_traj(data_path)
+        elif lazy:
+            self.data = torch.load(data_path, mmap=True)
+        else:
+            self.data = torch.load(data_path)
         self.data_set = NSE_Dataset
         self.norm = dict()
         self.Ndata = 0
@@ -276,9 +431,9 @@ class LoadData:
 
 
 class LoadDataNSE(LoadData):
-    def __init__(self, data_path):
-        super().__init__(data_path)
-        self.data_set = NSE_Dataset
+    def __init__(self, data_path, lazy=False):
+        super().__init__(data_path, lazy)
+        self.data_set = NSE_LazyDataset if lazy else NSE_Dataset
 
     def init_set(self):
         self.obs, self.Cd, self.Cl, self.ctr = self.data
@@ -353,13 +508,17 @@ class LoadDataNSE(LoadData):
 
     
 class LoadDataRBC(LoadData):
-    def __init__(self, data_path):
-        super().__init__(data_path)
-        self.data_set = RBC_Dataset
+    def __init__(self, data_path, lazy=False):
+        super().__init__(data_path, lazy)
+        self.data_set = RBC_LazyDataset if lazy else RBC_Dataset
 
     def init_set(self):
         self.obs, self.temp, self.ctr = self.data
-        self.ctr = self.ctr.reshape(self.ctr.shape[0], self.ctr.shape[1], 1, 1, 1).repeat(1, 1, self.obs.shape[2], self.obs.shape[3], 1)
+        self.ctr = self.ctr.reshape(self.ctr.shape[0], self.ctr.shape[1], 1, 1, 1)
+        if self.lazy:
+            self.ctr = self.ctr.expand(-1, -1, self.obs.shape[2], self.obs.shape[3], 1)
+        else:
+            self.ctr = self.ctr.repeat(1, 1, self.obs.shape[2], self.obs.shape[3], 1)
         self.temp = self.temp[:, 1:]
         self.data = [self.obs, self.temp, self.ctr]
 
@@ -392,8 +551,8 @@ class LoadDataRBC(LoadData):
     
 
 class LoadDataRBC1(LoadDataRBC):
-    def __init__(self, data_path):
-        super().__init__(data_path)
+    def __init__(self, data_path, lazy=False):
+        super().__init__(data_path, lazy)
 
     def init_set(self):
         self.obs, self.temp = self.data
@@ -406,8 +565,8 @@ class LoadDataRBC1(LoadDataRBC):
 
 
 class LoadDataRBC2(LoadDataRBC):
-    def __init__(self, data_path):
-        super().__init__(data_path)
+    def __init__(self, data_path, lazy=False):
+        super().__init__(data_path, lazy)
 
     def init_set(self):
         self.obs, self.temp = self.data
@@ -420,6 +579,37 @@ class LoadDataRBC2(LoadDataRBC):
 
 
 class NSE_Dataset(Dataset):
+    def __init__(self, data, mode='grid'):
+        # ctr, Cd, Cl stay per-sample scalars: (ipt, ctr [1], opt, coef = (Cd, Cl) [2])
+        if (mode == 'grid'):
+            N0, nt, nx, ny = data.get_params()
+            obs, Cd, Cl, ctr = data.get_data()
+            input_data = obs[:, :-1].reshape(-1, nx, ny, 3)
+            output_data = obs[:, 1:].reshape(-1, nx, ny, 3)
+        elif (mode == 'vertex'):
+            N0, nt, nv = data.get_params()
+            obs, Cd, Cl, ctr = data.get_data()
+            input_data = obs[:, :-1].reshape(-1, nv, 5)
+            output_data = obs[:, 1:].reshape(-1, nv, 5)
+        self.Ndata = data.Ndata
+
+        self.ipt = input_data
+        self.ctr = ctr.reshape(-1, 1)
+        self.opt = output_data
+        self.coef = torch.stack((Cd, Cl), dim=-1).reshape(-1, 2)
+
+    def __len__(self):
+        return self.Ndata
+
+    def __getitem__(self, idx):
+        x = torch.FloatTensor(self.ipt[idx])
+        ctr = torch.FloatTensor(self.ctr[idx])
+        y = torch.FloatTensor(self.opt[idx])
+        coef = torch.FloatTensor(self.coef[idx])
+        return x, ctr, y, coef
+
+
+class NSE_FieldDataset(Dataset):
     def __init__(self, data, mode='grid'):
         if (mode == 'grid'):
             N0, nt, nx, ny = data.get_params()
@@ -472,3 +662,40 @@ class RBC_Dataset(Dataset):
         y = torch.FloatTensor(self.opt[idx])
         return x, y
 
+
+class NSE_LazyDataset(Dataset):
+    def __init__(self, data):
+        # index (trajectory, timestep) pairs; samples are sliced from the (memory-mapped) data on demand
+        # and returned in the NSE_Dataset layout
+        N0, nt, nx, ny = data.get_params()
+        self.obs, self.Cd, self.Cl, self.ctr = data.get_data()
+        self.Ndata = data.Ndata
+        self.nt = nt
+
+    def __len__(self):
+        return self.Ndata
+
+    def __getitem__(self, idx):
+        n, t = divmod(int(idx), self.nt)
+        x = self.obs[n, t].float()
+        ctr = self.ctr[n, t].reshape(1).float()
+        y = self.obs[n, t+1].float()
+        coef = torch.stack((self.Cd[n, t], self.Cl[n, t])).float()
+        return x, ctr, y, coef
+
+
+class RBC_LazyDataset(Dataset):
+    def __init__(self, data):
+        N0, nt, nx, ny = data.get_params()
+        self.obs, self.temp, self.ctr = data.get_data()
+        self.Ndata = N0 * nt
+        self.nt = nt
+
+    def __len__(self):
+        return self.Ndata
+
+    def __getitem__(self, idx):
+        n, t = divmod(int(idx), self.nt)
+        x = torch.cat((self.obs[n, t], self.ctr[n, t]), dim=-1)
+        y = self.obs[n, t+1]
+        return x.float(), y.float()